@@ -1,138 +1,283 @@
 #!/usr/bin/env python
 
-import datetime
 import sys
 import optparse
 import logging
-import os
-import glob
 import random
-import sys
-import copy
+import socket
+import time
+import json
+import multiprocessing
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
-VERSION = '$Revision: 193 $'
+VERSION = '$Revision: 194 $'
 SERVER = 'itb4.uchicago.edu'
+# rows and columns of a block when multiplying matrices in python
+BLOCK_SIZE = 64
+# each measurement is repeated at least MIN_REPEAT times and until it has
+# taken MIN_SECONDS, the fastest run is reported
+MIN_REPEAT = 3
+MIN_SECONDS = 1.0
+# size in MB of the buffers copied to measure memory bandwidth
+STREAM_MB = 64
+
+
+def random_matrix(size, seed):
+  """
+  Generate a size x size matrix of integers between 1 and 100
+  """
+  generator = random.Random(seed)
+  return [[float(generator.randint(1, 100)) for j in range(size)]
+          for i in range(size)]
+
+def inversion_flops(size):
+  """
+  Get the floating point operations used by gauss-jordan elimination on a
+  size x 2 * size augmented matrix
+  """
+  columns = 2 * size * size - size * (size - 1) // 2
+  return columns * (2 * size - 1)
+
+def invert_python(matrix):
+  """
+  Invert a matrix using gauss-jordan elimination with partial pivoting
+  on lists, returns None if the matrix is singular
+  """
+  size = len(matrix)
+  augmented = []
+  for i in range(size):
+    identity = [0.0] * size
+    identity[i] = 1.0
+    augmented.append(matrix[i] + identity)
+  for i in range(size):
+    pivot_row = max(range(i, size), key=lambda j: abs(augmented[j][i]))
+    if augmented[pivot_row][i] == 0.0:
+      return None
+    augmented[i], augmented[pivot_row] = augmented[pivot_row], augmented[i]
+    # columns left of i are already zero in every row but their pivot row
+    scaling_factor = 1.0 / augmented[i][i]
+    pivot = [x * scaling_factor for x in augmented[i][i:]]
+    augmented[i][i:] = pivot
+    for j in range(size):
+      factor = augmented[j][i]
+      if j != i and factor != 0.0:
+        augmented[j][i:] = [x - factor * y
+                            for x, y in zip(augmented[j][i:], pivot)]
+  return [row[size:] for row in augmented]
+
+def identity_error_python(matrix, inverse):
+  """
+  Get the largest difference between matrix * inverse and the identity
+  matrix, the product is computed in blocks without being stored
+  """
+  size = len(matrix)
+  columns = [list(column) for column in zip(*inverse)]
+  error = 0.0
+  for row_block in range(0, size, BLOCK_SIZE):
+    for column_block in range(0, size, BLOCK_SIZE):
+      block_columns = columns[column_block:column_block + BLOCK_SIZE]
+      for i in range(row_block, min(row_block + BLOCK_SIZE, size)):
+        row = matrix[i]
+        j = column_block
+        for column in block_columns:
+          value = sum([x * y for x, y in zip(row, column)])
+          if i == j:
+            value -= 1.0
+          error = max(error, abs(value))
+          j += 1
+  return error
+
+def copy_python(buffer_size):
+  """
+  Return a function copying one buffer_size byte buffer to another
+  """
+  source = bytearray(buffer_size)
+  dest = bytearray(buffer_size)
+  def copy():
+    dest[:] = source
+  return copy
+
+def invert_numpy(matrix):
+  """
+  Invert a matrix using gauss-jordan elimination with partial pivoting,
+  each step updates the whole augmented matrix with numpy, returns None
+  if the matrix is singular
+  """
+  size = matrix.shape[0]
+  augmented = numpy.hstack([matrix, numpy.eye(size)])
+  for i in range(size):
+    pivot_row = i + int(numpy.argmax(numpy.abs(augmented[i:, i])))
+    if augmented[pivot_row, i] == 0.0:
+      return None
+    if pivot_row != i:
+      augmented[[i, pivot_row]] = augmented[[pivot_row, i]]
+    augmented[i, i:] /= augmented[i, i]
+    factors = augmented[:, i].copy()
+    factors[i] = 0.0
+    augmented[:, i:] -= numpy.outer(factors, augmented[i, i:])
+  return augmented[:, size:]
 
-def run_test():
+def identity_error_numpy(matrix, inverse):
   """
-  Run test
+  Get the largest difference between matrix * inverse and the identity
+  matrix
   """
+  product = numpy.dot(matrix, inverse)
+  product -= numpy.eye(matrix.shape[0])
+  return float(numpy.abs(product).max())
+
+def copy_numpy(buffer_size):
+  """
+  Return a function copying one buffer_size byte array to another
+  """
+  source = numpy.ones(buffer_size // 8)
+  dest = numpy.zeros(buffer_size // 8)
+  def copy():
+    dest[:] = source
+  return copy
+
+def best_time(function, *args):
+  """
+  Time function, returns the fastest time and the result of the last run
+  """
+  times = []
+  start = time.time()
+  while len(times) < MIN_REPEAT or time.time() - start < MIN_SECONDS:
+    run_start = time.time()
+    result = function(*args)
+    times.append(time.time() - run_start)
+  return (min(times), result)
+
+def run_benchmark(settings):
+  """
+  Run the inversion and memory bandwidth benchmarks, returns a dict
+  with the results
+  """
+  (kernel, size, seed, stream_mb) = settings
+  matrix = random_matrix(size, seed)
+  buffer_size = stream_mb * 1024 * 1024
+  if kernel == 'numpy':
+    matrix = numpy.array(matrix)
+    (seconds, inverse) = best_time(invert_numpy, matrix)
+    if inverse is not None:
+      error = identity_error_numpy(matrix, inverse)
+    copy_seconds = best_time(copy_numpy(buffer_size))[0]
+  else:
+    (seconds, inverse) = best_time(invert_python, matrix)
+    if inverse is not None:
+      error = identity_error_python(matrix, inverse)
+    copy_seconds = best_time(copy_python(buffer_size))[0]
+  if inverse is None:
+    error = None
+  # a copy reads and writes each byte
+  return {'seed': seed,
+          'seconds': seconds,
+          'gflops': inversion_flops(size) / seconds / 1e9,
+          'bandwidth_mbs': 2 * buffer_size / copy_seconds / 1024 / 1024,
+          'max_error': error}
+
+def run_test(options):
+  """
+  Run the benchmark in each process and return a dict with the
+  results
+  """
+  logger = logging.getLogger('cpu_burn.py')
+  settings = [(options.kernel, options.size, options.seed + process,
+               options.stream_mb) for process in range(options.processes)]
+  logger.info("running %s kernel with a %dx%d matrix in %d processes" %
+              (options.kernel, options.size, options.size, options.processes))
+  start = time.time()
+  if options.processes == 1:
+    workers = [run_benchmark(settings[0])]
+  else:
+    pool = multiprocessing.Pool(options.processes)
+    workers = pool.map(run_benchmark, settings)
+    pool.close()
+    pool.join()
+  logger.info("finished in %.1fs" % (time.time() - start))
+  errors = [worker['max_error'] for worker in workers]
+  if None in errors:
+    max_error = None
+  else:
+    max_error = max(errors)
+  return {'version': VERSION,
+          'host': socket.gethostname(),
+          'kernel': options.kernel,
+          'size': options.size,
+          'seed': options.seed,
+          'processes': options.processes,
+          'flops': inversion_flops(options.size),
+          'gflops': sum([worker['gflops'] for worker in workers]),
+          'bandwidth_mbs': sum([worker['bandwidth_mbs']
+                                for worker in workers]),
+          'max_error': max_error,
+          'seconds': time.time() - start,
+          'workers': workers}
+
+def main():
+  """
+  Parse options, run the benchmark and write its results as JSON
+  """
+  parser = optparse.OptionParser(usage='Usage: %prog [options] [size]',
+                                 version='%prog ' + VERSION)
+  parser.add_option('-s', '--size', dest='size', type='int', default=600,
+                    help='Rows and columns in the matrix to invert')
+  parser.add_option('--seed', dest='seed', type='int', default=42,
+                    help='Seed for the random matrix, process n uses ' \
+                         'seed + n')
+  parser.add_option('-p', '--processes', dest='processes', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help='Number of processes to run the benchmark in, ' \
+                         'defaults to the number of cores')
+  parser.add_option('-k', '--kernel', dest='kernel', default='auto',
+                    choices=['auto', 'numpy', 'python'],
+                    help='Use the numpy or python kernel, auto uses numpy ' \
+                         'if it is available')
+  parser.add_option('--stream-mb', dest='stream_mb', type='int',
+                    default=STREAM_MB,
+                    help='Size in MB of the buffers copied to measure ' \
+                         'memory bandwidth')
+  parser.add_option('-o', '--output', dest='output', default='-',
+                    help='File to write the JSON results to, - for stdout')
+  (options, args) = parser.parse_args()
+  if len(args) == 1:
+    try:
+      options.size = int(args[0])
+    except ValueError:
+      parser.error("Size must be an integer")
+  if options.size < 1 or options.processes < 1 or options.stream_mb < 1:
+    parser.error("Size, processes and stream size must be positive")
+  if options.kernel == 'auto':
+    if numpy is None:
+      options.kernel = 'python'
+    else:
+      options.kernel = 'numpy'
+  elif options.kernel == 'numpy' and numpy is None:
+    parser.error("numpy kernel requested but numpy is not available")
 
   logger = logging.getLogger('cpu_burn.py')
   logger.setLevel(logging.DEBUG)
   console_handler = logging.StreamHandler()
   console_handler.setLevel(logging.INFO)
   logger.addHandler(console_handler)
-  logger.info("logging setup")
 
-  invert()
-  logger.info("finished inversion")
-  logger.info("")
+  results = run_test(options)
+  if options.output == '-':
+    output = sys.stdout
+  else:
+    output = open(options.output, 'w')
+  output.write(json.dumps(results, sort_keys=True) + "\n")
+  if output is not sys.stdout:
+    output.close()
+  if results['max_error'] is None:
+    logger.error("matrix is singular, try another seed")
+    sys.exit(1)
   sys.exit(0)
 
 
-
-def mac(row1, row2, scaling_factor):
-    """Multiply and Accumulate (MAC) row1 by scaling_factor and add row2"""
-    temp = map(lambda x: x * scaling_factor, row1)
-    for i in range(0, len(row1)):
-        temp[i] = temp[i] + row2[i]
-    return temp
-
-def dot_product(row, column):
-    """Get the dot product of a row and column"""
-    sum = 0.0
-    for i in range(0, len(row)):
-        sum += row[i] * column[i]
-    return sum
-
-def column(matrix, j):
-    """Get return a list with the jth column of the matrix"""
-    temp = []
-    for i in range(0, len(matrix)):
-        temp.append(matrix[i][j])
-    return temp
-
-def invert(size = 600, seed =  42):
-  """
-  Generate and invert a matrix
-  """
-
-  random.seed(seed)
-
-  # generate a size x 2 * size matrix with
-  # a_ij is an integer between 1 and 100 if j < size
-  # a_ij corresponds to the identity matrix if j > size
-  # i.e. create a random size x size matrix augmented with the identity matrix
-  if len(sys.argv) == 2:
-      try:
-          temp = int(sys.argv[1])
-          size = temp
-      except:
-          pass
-  matrix = []
-  for i in range(0, size):
-      matrix.append([])
-      for j in range(0, 2*size):
-          if j < size:
-              matrix[i].append(random.randint(1, 100))
-          elif (size + i) == j:
-              matrix[i].append(1)
-          else:
-              matrix[i].append(0)
-
-  # copy by value
-  inverse = copy.deepcopy(matrix)
-  # use gauss-jordan elimination to calculate inverse
-  # fiddle around with row values to get an upper triangular matrix
-  for i in range(0, size):
-      # find pivot row and pivot
-      pivot_row = i
-      pivot_value = abs(inverse[i][i])
-      for j in range(i, size):
-          if abs(inverse[j][i]) > pivot_value:
-              pivot_row = j
-              pivot_value = abs(inverse[j][i])
-      if pivot_row != i:
-          temp = inverse[i]
-          inverse[i] = inverse[j]
-          inverse[j] = temp
-      # convert pivot value to a floating point number if it isn't already
-      pivot_value = float(pivot_value)
-
-      # scale and add rows to reduce matrix to upper triangular form
-      for j in range(i + 1, size):
-         scaling_factor = inverse[j][i] /  pivot_value * -1
-         inverse[j] = mac(inverse[i], inverse[j], scaling_factor)
-
-  # fiddle around more with the rows to get a diagonal matrix
-  # this time start from the bottom and work up
-  foo = range(0, size)
-  foo.reverse()
-  for i in foo:
-      value = float(inverse[i][i])
-      for j in range(0, i):
-          scaling_factor = inverse[j][i] / value * -1
-          inverse[j] = mac(inverse[i], inverse[j], scaling_factor)
-
-  # scale each row to get the identity matrix
-  for i in range(0, size):
-      scaling_factor =  1 / float(inverse[i][i])
-      inverse[i] = map(lambda x: x * scaling_factor, inverse[i])
-
-  # extract original and inverse matrices from augmented matrices
-  # original = AI  inverse = IA^(-1)
-  for i in range(0, size):
-      matrix[i] = matrix[i][0:size]
-      inverse[i] = inverse[i][size:2*size]
-
-  # multiply original and inverse matrices  and verify that identity matrix results
-  temp = copy.deepcopy(matrix)
-  for i in range(0, size):
-      for j in range(0, size):
-          temp[i][j] = dot_product(matrix[i], column(inverse, j))
-
-
-
 if __name__ == "__main__":
-    run_test()
+  main()
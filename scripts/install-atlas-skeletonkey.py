@@ -23,6 +23,8 @@
 import os, optparse, sys, re, urllib2, tarfile, tempfile, shutil, platform
 
 VERSION = '0.9'
+# size of reads when downloading and extracting tarballs
+DOWNLOAD_BUFSIZE = 1024 * 1024
 
 def setup_skeletonkey(options, sk_dir):
     """Setup .skeletonkey and setup skeletonkey options"""
@@ -35,18 +37,17 @@ def setup_skeletonkey(options, sk_dir):
 def download_tarball(url, path):
     """Download a tarball from a given url and extract it to specified path"""
 
-    (fhandle, download_file) = tempfile.mkstemp(dir=path)
     url_handle = urllib2.urlopen(url)
-    url_data = url_handle.read(2048)
-    while url_data:
-        os.write(fhandle, url_data)
-        url_data = url_handle.read(2048)
-    os.close(fhandle)
-    downloaded_tarfile = tarfile.open(download_file)
-    extract_path = os.path.join(path,
-                                downloaded_tarfile.getmembers()[0].name)
-    downloaded_tarfile.extractall(path=path)
-    os.unlink(download_file)
+    tar_stream = tarfile.open(fileobj=url_handle,
+                              mode='r|*',
+                              bufsize=DOWNLOAD_BUFSIZE)
+    extract_path = None
+    for tar_info in tar_stream:
+        if extract_path is None:
+            extract_path = os.path.join(path, tar_info.name)
+        tar_stream.extract(tar_info, path)
+    tar_stream.close()
+    url_handle.close()
     return extract_path
 
 def setup_sk_binaries(options):
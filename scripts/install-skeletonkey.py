@@ -21,8 +21,21 @@
 # limitations under the License.
 
 import os, optparse, sys, re, urllib2, tarfile, tempfile, shutil, platform
+import hashlib, json, threading, subprocess, multiprocessing
 
 VERSION = '0.10'
+# size of reads when downloading and extracting tarballs
+DOWNLOAD_BUFSIZE = 1024 * 1024
+# cctools tarballs repackaged into parrot tarballs for each os version
+CCTOOLS_URL = "http://uc3-data.uchicago.edu/parrot/" \
+              "cctools-current-x86_64-redhat%s.tar.gz"
+CCTOOLS_VERSIONS = ('5', '6')
+# directories in the cctools tarballs left out of the parrot tarballs
+PARROT_EXCLUDE = ('doc', 'share')
+# file in the install directory recording the checksums and http headers
+# of the cctools tarballs and the checksums of the parrot tarballs made
+# from them, used to skip versions that haven't changed
+CCTOOLS_STATE = 'cctools.json'
 
 def setup_chirp(options, cctools_dir):
     """Setup .chirp and setup chirp options"""
@@ -40,6 +53,10 @@ def setup_chirp(options, cctools_dir):
         sys.exit(1)
     chirp_config.write("CCTOOLS_BINDIR=%s\n" % cctools_dir)
     chirp_config.write("CHIRP_HOST=%s\n" % os.uname()[1])
+    chirp_config.write("CHIRP_INSTANCES=%d\n" % options.chirp_instances)
+    if options.chirp_servers is not None:
+        chirp_config.write("CHIRP_SERVERS=\"%s\"\n" % 
+                           " ".join(options.chirp_servers.split(',')))
     chirp_config.close()
 
 def setup_skeletonkey(options, sk_dir):
@@ -50,50 +67,251 @@ def setup_skeletonkey(options, sk_dir):
     sk_config.write("location = %s\n" % sk_dir)
     sk_config.close()
 
+def extract_tarball(handle, path):
+    """Extract a tarball from an open file to path, returns the first member"""
+    tar_stream = tarfile.open(fileobj=handle,
+                              mode='r|*',
+                              bufsize=DOWNLOAD_BUFSIZE)
+    extract_path = None
+    for tar_info in tar_stream:
+        if extract_path is None:
+            extract_path = os.path.join(path, tar_info.name)
+        tar_stream.extract(tar_info, path)
+    tar_stream.close()
+    return extract_path
+
 def download_tarball(url, path):
     """Download a tarball from a given url and extract it to specified path"""
 
-    (fhandle, download_file) = tempfile.mkstemp(dir=path)
     url_handle = urllib2.urlopen(url)
-    url_data = url_handle.read(2048)
-    while url_data:
-        os.write(fhandle, url_data)
-        url_data = url_handle.read(2048)
-    os.close(fhandle)
-    downloaded_tarfile = tarfile.open(download_file)
-    extract_path = os.path.join(path,
-                                downloaded_tarfile.getmembers()[0].name)
-    downloaded_tarfile.extractall(path=path)
-    os.unlink(download_file)
+    extract_path = extract_tarball(url_handle, path)
+    url_handle.close()
     return extract_path
 
+def file_sha256(path):
+    """Get the sha256 checksum of a file"""
+    checksum = hashlib.sha256()
+    file_handle = open(path, 'rb')
+    data = file_handle.read(DOWNLOAD_BUFSIZE)
+    while data:
+        checksum.update(data)
+        data = file_handle.read(DOWNLOAD_BUFSIZE)
+    file_handle.close()
+    return checksum.hexdigest()
+
+def link_file(source, dest):
+    """Hard link source to dest, replacing dest if it exists"""
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    os.link(source, dest)
+
+def replace_dir(new_dir, dest):
+    """
+    Move new_dir to dest, an existing dest is moved out of the way first 
+    and then removed so programs running from it keep their files
+    """
+    old_dir = None
+    if os.path.lexists(dest):
+        old_dir = tempfile.mkdtemp(dir=os.path.dirname(dest))
+        os.rename(dest, os.path.join(old_dir, os.path.basename(dest)))
+    os.rename(new_dir, dest)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+def read_cctools_state(bin_dir):
+    """Read the recorded state of the cctools tarballs"""
+    try:
+        return json.loads(open(os.path.join(bin_dir, CCTOOLS_STATE)).read())
+    except (IOError, ValueError):
+        return {}
+
+def write_cctools_state(bin_dir, state):
+    """Atomically write the state of the cctools tarballs"""
+    (fhandle, temp_file) = tempfile.mkstemp(dir=bin_dir)
+    os.write(fhandle, json.dumps(state, indent=2, sort_keys=True))
+    os.close(fhandle)
+    os.rename(temp_file, os.path.join(bin_dir, CCTOOLS_STATE))
+
+def parrot_current(bin_dir, os_version, version_state):
+    """
+    Check that the parrot tarball and the cctools directory made from the
+    recorded cctools tarball are still there and unmodified
+    """
+    tarball = os.path.join(bin_dir, "parrot-sl%s.tar.gz" % os_version)
+    if (version_state.get('tarball_sha256') is None or
+        not os.path.isfile(tarball)):
+        return False
+    if (os_version == platform.dist()[1][0] and
+        not os.path.isdir(version_state.get('cctools_dir', ''))):
+        return False
+    return file_sha256(tarball) == version_state['tarball_sha256']
+
+def fetch_cctools(url, bin_dir, version_state, current):
+    """
+    Download a cctools tarball to a temporary file in bin_dir, returns a
+    tuple with the file and the response headers or (None, None) if the
+    tarball hasn't changed since it was last packaged
+    """
+    request = urllib2.Request(url)
+    if current and version_state.get('etag'):
+        request.add_header('If-None-Match', version_state['etag'])
+    if current and version_state.get('last_modified'):
+        request.add_header('If-Modified-Since', version_state['last_modified'])
+    try:
+        url_handle = urllib2.urlopen(request)
+    except urllib2.HTTPError, ex:
+        if ex.code == 304:
+            return (None, None)
+        raise
+    (fhandle, temp_file) = tempfile.mkstemp(dir=bin_dir)
+    temp_handle = os.fdopen(fhandle, 'wb')
+    shutil.copyfileobj(url_handle, temp_handle, DOWNLOAD_BUFSIZE)
+    temp_handle.close()
+    headers = url_handle.info()
+    url_handle.close()
+    return (temp_file, headers)
+
+def pack_parrot(cctools_dir, tarball):
+    """
+    Write the parrot tarball for a cctools directory, compressing with
+    pigz on every core if it's installed.  Without pigz the tarball is 
+    compressed with gzip on a single core.
+    """
+    pigz_path = None
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, 'pigz'), os.X_OK):
+            pigz_path = os.path.join(path, 'pigz')
+            break
+    if pigz_path is not None:
+        sys.stdout.write("Compressing %s with pigz on %d cores\n" %
+                         (tarball, multiprocessing.cpu_count()))
+    else:
+        sys.stdout.write("pigz not found, compressing %s with gzip on " \
+                         "one core\n" % tarball)
+    (fhandle, temp_file) = tempfile.mkstemp(dir=os.path.dirname(tarball))
+    output = os.fdopen(fhandle, 'wb')
+    pigz = None
+    tar_file = None
+    try:
+        if pigz_path is not None:
+            pigz = subprocess.Popen([pigz_path, 
+                                     '-p', 
+                                     str(multiprocessing.cpu_count()),
+                                     '-c'],
+                                    stdin=subprocess.PIPE,
+                                    stdout=output)
+            tar_file = tarfile.open(fileobj=pigz.stdin, mode='w|')
+        else:
+            tar_file = tarfile.open(fileobj=output, mode='w:gz')
+        tar_file.add(cctools_dir, 'parrot', recursive=False)
+        for name in sorted(os.listdir(cctools_dir)):
+            if name not in PARROT_EXCLUDE:
+                tar_file.add(os.path.join(cctools_dir, name), 
+                             os.path.join('parrot', name))
+        tar_file.close()
+        if pigz is not None:
+            pigz.stdin.close()
+            if pigz.wait() != 0:
+                raise IOError("pigz failed compressing %s" % tarball)
+        output.close()
+    except:
+        # stop pigz and remove the partial tarball before passing the 
+        # error on
+        error = sys.exc_info()
+        if tar_file is not None:
+            try:
+                tar_file.close()
+            except (IOError, OSError, ValueError):
+                pass
+        if pigz is not None:
+            try:
+                pigz.stdin.close()
+            except IOError:
+                pass
+            pigz.wait()
+        output.close()
+        os.unlink(temp_file)
+        raise error[0], error[1], error[2]
+    os.chmod(temp_file, 0644)
+    os.rename(temp_file, tarball)
+
+def setup_cctools_version(bin_dir, os_version, state):
+    """
+    Download and repackage the cctools tarball for an os version unless 
+    it's unchanged, updates the version's entry in state
+    """
+    url = CCTOOLS_URL % os_version
+    version_state = state.get(os_version, {})
+    if version_state.get('url') != url:
+        version_state = {}
+    tarball = os.path.join(bin_dir, "parrot-sl%s.tar.gz" % os_version)
+    current = parrot_current(bin_dir, os_version, version_state)
+    (temp_file, headers) = fetch_cctools(url, bin_dir, version_state, 
+                                         current)
+    if temp_file is None:
+        sys.stdout.write("cctools for SL%s unchanged\n" % os_version)
+        return
+    try:
+        source_sha256 = file_sha256(temp_file)
+        if current and source_sha256 == version_state.get('source_sha256'):
+            sys.stdout.write("cctools for SL%s unchanged\n" % os_version)
+        else:
+            # extract next to the installed cctools and swap the new 
+            # directory in, files of a running chirp_server aren't 
+            # overwritten and files dropped upstream don't linger
+            extract_dir = tempfile.mkdtemp(dir=bin_dir)
+            try:
+                temp_handle = open(temp_file, 'rb')
+                first_member = extract_tarball(temp_handle, extract_dir)
+                temp_handle.close()
+                top = os.path.relpath(first_member, extract_dir).split(os.sep)[0]
+                new_dir = os.path.join(extract_dir, top)
+                cctools_dir = os.path.join(os.path.abspath(bin_dir), top)
+                pack_parrot(new_dir, tarball)
+                if os_version == platform.dist()[1][0]:
+                    replace_dir(new_dir, cctools_dir)
+            finally:
+                shutil.rmtree(extract_dir, ignore_errors=True)
+            version_state = {'url': url,
+                             'source_sha256': source_sha256,
+                             'tarball_sha256': file_sha256(tarball),
+                             'cctools_dir': cctools_dir}
+            sys.stdout.write("Packaged parrot for SL%s\n" % os_version)
+    finally:
+        os.unlink(temp_file)
+    version_state['etag'] = headers.getheader('ETag')
+    version_state['last_modified'] = headers.getheader('Last-Modified')
+    state[os_version] = version_state
+
 def setup_cctools_binaries(options):
     """Download the appropriate version of cctools and install"""
-    for os_version in ('5', '6'):
-      cctools_url = "http://uc3-data.uchicago.edu/parrot/" \
-                    "cctools-current-x86_64-redhat%s.tar.gz" % (os_version)
-      cctools_dir = download_tarball(cctools_url, options.bin_dir)
-      if os_version == platform.dist()[1][0]: 
-        os.link(os.path.join(cctools_dir, 'bin', 'chirp_server'),
-                os.path.join(options.bin_dir, 'chirp_server'))
-        os.link(os.path.join(cctools_dir, 'bin', 'chirp_server_hdfs'),
-                os.path.join(options.bin_dir, 'chirp_server_hdfs'))
-        os.link(os.path.join(cctools_dir, 'bin', 'chirp'),
-                os.path.join(options.bin_dir, 'chirp'))
-        sys_cctools_dir = cctools_dir
-      shutil.copytree(cctools_dir, os.path.join(options.bin_dir, 'parrot'))
-      current_dir = os.getcwd()
-      os.chdir(options.bin_dir)
-      shutil.rmtree(os.path.join('parrot', 'doc'))
-      shutil.rmtree(os.path.join('parrot', 'share'))
-      tarball = tarfile.open("parrot-sl%s.tar.gz" % os_version, mode='w:gz')
-      tarball.add('parrot')
-      tarball.close()
-      shutil.rmtree('parrot')
-      if os_version != platform.dist()[1][0]:
-        shutil.rmtree(cctools_dir)
-      os.chdir(current_dir)
+    state = read_cctools_state(options.bin_dir)
+    errors = []
+    def setup_version(os_version):
+        try:
+            setup_cctools_version(options.bin_dir, os_version, state)
+        except Exception, ex:
+            errors.append("Can't set up cctools for SL%s: %s" % 
+                          (os_version, ex))
+    threads = []
+    for os_version in CCTOOLS_VERSIONS:
+        thread = threading.Thread(target=setup_version, args=(os_version,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    write_cctools_state(options.bin_dir, state)
+    if errors != []:
+        sys.stderr.write("\n".join(errors) + "\n")
+        sys.exit(1)
 
+    if platform.dist()[1][0] not in state:
+        sys.stderr.write("No cctools binaries for this os version\n")
+        sys.exit(1)
+    sys_cctools_dir = state[platform.dist()[1][0]]['cctools_dir']
+    for binary in ('chirp_server', 'chirp_server_hdfs', 'chirp'):
+        link_file(os.path.join(sys_cctools_dir, 'bin', binary),
+                  os.path.join(options.bin_dir, binary))
     return os.path.abspath(sys_cctools_dir)
 
 def setup_sk_binaries(options):
@@ -101,10 +319,10 @@ def setup_sk_binaries(options):
 
     sk_url = "http://uc3-data.uchicago.edu/sk/skeleton-key-current.tar.gz"   
     sk_dir = download_tarball(sk_url, options.bin_dir)
-    os.link(os.path.join(sk_dir, 'scripts', 'skeleton_key'),
-            os.path.join(options.bin_dir, 'skeleton_key'))
-    os.link(os.path.join(sk_dir, 'scripts', 'chirp_control'),
-            os.path.join(options.bin_dir, 'chirp_control'))
+    link_file(os.path.join(sk_dir, 'scripts', 'skeleton_key'),
+              os.path.join(options.bin_dir, 'skeleton_key'))
+    link_file(os.path.join(sk_dir, 'scripts', 'chirp_control'),
+              os.path.join(options.bin_dir, 'chirp_control'))
     return os.path.abspath(sk_dir)
 
 
@@ -120,6 +338,14 @@ def install_application():
     parser.add_option("-u", "--hdfs-uri", dest="hdfs_uri",
                       help="URI of HDFS directory to export, exclusive with -e",
                       metavar="HDFS_URI")
+    parser.add_option("-n", "--chirp-instances", dest="chirp_instances",
+                      help="Number of chirp servers to run on this host",
+                      type="int", default=1,
+                      metavar="INSTANCES")
+    parser.add_option("-s", "--chirp-servers", dest="chirp_servers",
+                      help="Comma separated host:port list of chirp servers "
+                           "on other hosts exporting the same directory",
+                      metavar="SERVERS")
     (options, args) = parser.parse_args()
     
     if (options.hdfs_uri is not None and  options.export_dir is not None):
@@ -21,7 +21,7 @@
 # limitations under the License.
 
 import sys, os, subprocess, shutil, optparse, platform, tempfile, urllib2, tarfile
-import urlparse, time, re
+import urlparse, time, re, threading, Queue, hashlib, json, signal
 
 WEB_PROXY= 'uc3-data.uchicago.edu:3128'
 USER_PROXY = """%%%USER_PROXY%%%"""
@@ -31,6 +31,30 @@ JOB_SCRIPT = '%%%JOB_SCRIPT%%%'
 JOB_ARGS = %%%JOB_ARGS%%%
 CVMFS_INFO = {'atlas.cern.ch': {'options': 'url=http://cvmfs.racf.bnl.gov:8000/opt/atlas;http://cvmfs-stratum-one.cern.ch:8000/opt/atlas,pubkey=cern.ch.pub,quota_limit=2000,proxies=uc3-data.uchicago.edu:3128', 'key': 'http://uc3-data.uchicago.edu/keys/cern.ch.pub'}, 'oasis.opensciencegrid.org': {'options': 'url=http://oasis-replica.opensciencegrid.org:8000/cvmfs/oasis;http://cvmfs.fnal.gov:8000/cvmfs/oasis;http://cvmfs.racf.bnl.gov:8000/cvmfs/oasis,pubkey=opensciencegrid.org.pub,quota_limit=2000,proxies=uc3-data.uchicago.edu:3128', 'key': 'http://uc3-data.uchicago.edu/keys/opensciencegrid.org.pub'}, 'atlas-condb.cern.ch': {'options': 'url=http://cvmfs.racf.bnl.gov:8000/opt/atlas-condb;http://cvmfs-stratum-one.cern.ch:8000/opt/atlas-condb,pubkey=cern.ch.pub,quota_limit=2000,proxies=uc3-data.uchicago.edu:3128', 'key': 'http://uc3-data.uchicago.edu/keys/cern.ch.pub'}, 'osg.mwt2.org': {'options': 'url=http://uct2-cvmfs.mwt2.org/opt/osg,pubkey=mwt2.org.pub,quota_limit=2000,proxies=uc3-data.uchicago.edu:3128', 'key': 'http://uc3-data.uchicago.edu/keys/mwt2.org.pub'}}
 VERSION = '0.10'
+# size of reads when downloading and extracting tarballs
+DOWNLOAD_BUFSIZE = 1024 * 1024
+# maximum number of downloads to run at the same time when staging in
+STAGE_THREADS = 4
+# seconds a stored cvmfs key is used without checking the server
+KEY_FRESHNESS = 3600
+# seconds to wait on a key server before giving up on a request
+DOWNLOAD_TIMEOUT = 60
+# cvmfs paths read into the parrot cache by a background parrot process 
+# while the application is staged, directories are read recursively and
+# paths starting with @ are manifests listing the paths to read, 
+# CVMFS_WARM_READERS files are read at a time
+CVMFS_WARM = %%%CVMFS_WARM%%%
+CVMFS_WARM_READERS = 8
+CVMFS_WARM_SCRIPT = """
+for path in "$@"; do
+  case "$path" in
+    @*) cat "${path#@}" ;;
+    *) find "$path" -type f ;;
+  esac
+done | xargs -d '\\n' -P %d -n 16 cat > /dev/null
+""" % CVMFS_WARM_READERS
+# parrot processes warming the cache, stopped once the application exits
+WARM_PROCESSES = []
 
 def write_proxy(directory):
   """
@@ -46,25 +70,28 @@ def write_proxy(directory):
   except IOError:
     return None
 
+def extract_stream(stream, path):
+  """
+  Extract a (compressed) tar stream to path while it's being read and
+  return the path of the first member extracted
+  """
+  tar_stream = tarfile.open(fileobj=stream, 
+                            mode='r|*', 
+                            bufsize=DOWNLOAD_BUFSIZE)
+  extract_path = None
+  for tar_info in tar_stream:
+    if extract_path is None:
+      extract_path = os.path.join(path, tar_info.name)
+    tar_stream.extract(tar_info, path)
+  tar_stream.close()
+  return extract_path
+
 def download_tarball(url, path):
   """Download a tarball from a given url and extract it to specified path"""
 
-  (fhandle, download_file) = tempfile.mkstemp(dir=path)
   url_handle = urllib2.urlopen(url)
-  url_data = url_handle.read(2048)
-  while url_data:
-    os.write(fhandle, url_data)
-    url_data = url_handle.read(2048)
-  os.close(fhandle)
-  downloaded_tarfile = tarfile.open(download_file)
-  cur_dir = os.getcwd()
-  os.chdir(path)
-  extract_path = os.path.join(path,
-                              downloaded_tarfile.getmembers()[0].name)
-  for tar_info in downloaded_tarfile:
-    downloaded_tarfile.extract(tar_info)
-  os.unlink(download_file)
-  os.chdir(cur_dir)
+  extract_path = extract_stream(url_handle, path)
+  url_handle.close()
   return extract_path
 
 def setup_application(directory):
@@ -83,9 +110,20 @@ def setup_parrot(directory):
   parrot_path = download_tarball(parrot_url, directory)
   return parrot_path
 
-def generate_env(parrot_path):
+def parrot_needed():
   """
-  Create a dict with the environment variables for binary + parrot
+  Check whether the job needs to run under parrot, parrot is only needed
+  if a cvmfs repository isn't mounted on the node
+  """
+  for k in CVMFS_INFO:
+    if not os.path.isdir(os.path.join('/', 'cvmfs', k)):
+      return True
+  return False
+
+def generate_env(parrot_path, native=False):
+  """
+  Create a dict with the environment variables for binary + parrot, 
+  parrot specific variables are left out if the binary runs natively
   """
   job_env = os.environ.copy()
     
@@ -95,11 +133,12 @@ def generate_env(parrot_path):
   if job_env.has_key('OSG_SQUID_LOCATION') and job_env['OSG_SQUID_LOCATION'] != 'UNAVAILABLE':
     job_env['http_proxy'] = job_env['OSG_SQUID_LOCATION']
     job_env['HTTP_PROXY'] = job_env['OSG_SQUID_LOCATION']
-  job_env['PARROT_ALLOW_SWITCHING_CVMFS_REPOSITORIES'] = '1'
-  job_env['PARROT_HELPER'] = os.path.join(parrot_path,
-                                          'parrot',
-                                          'lib',
-                                          'libparrot_helper.so')
+  if not native:
+    job_env['PARROT_ALLOW_SWITCHING_CVMFS_REPOSITORIES'] = '1'
+    job_env['PARROT_HELPER'] = os.path.join(parrot_path,
+                                            'parrot',
+                                            'lib',
+                                            'libparrot_helper.so')
   return job_env 
 
 def update_proxy(cvmfs_options):
@@ -128,32 +167,261 @@ def create_cvmfs_options():
     cvmfs_opts += "%s:%s " % (k, cvmfs_options)
   return cvmfs_opts[:-1]
 
-def get_cvmfs_keys(temp_dir):
+def get_key_store():
+  """
+  Get the directory on the node used to keep cvmfs keys between jobs,
+  returns None if it can't be created
+  """
+  base_dir = os.environ.get('OSG_WN_TMP', tempfile.gettempdir())
+  key_store = os.path.join(base_dir, 
+                           "skeletonkey-cache-%s" % os.getuid(),
+                           'keys')
+  try:
+    if not os.path.isdir(key_store):
+      os.makedirs(key_store, 0700)
+  except OSError:
+    return None
+  return key_store
+
+def get_cvmfs_key_urls():
   """
-  Download cvmfs keys for repositories that have been defined
+  Get the urls for the keys of the cvmfs repositories that will be
+  configured, repositories sharing a key only get one entry and 
+  repositories mounted on the node are skipped
   """
+  key_urls = []
   for k in CVMFS_INFO:
-    key_url = CVMFS_INFO[k]['key']
-    url_handle = urllib2.urlopen(key_url)
-    key_name = urlparse.urlparse(key_url)[2].split('/')[-1]
-    key_file = open(os.path.join(temp_dir, key_name), 'w')
+    if os.path.isdir(os.path.join('/', 'cvmfs', k)):
+      continue
+    if CVMFS_INFO[k]['key'] not in key_urls:
+      key_urls.append(CVMFS_INFO[k]['key'])
+  return key_urls
+
+def fetch_cvmfs_key(key_url, key_store):
+  """
+  Make sure the key store has a current copy of the key at key_url,
+  revalidating stored keys with the server, and return its location
+  """
+  stored_key = os.path.join(key_store, hashlib.sha1(key_url).hexdigest())
+  try:
+    key_info = json.loads(open(stored_key + '.info').read())
+  except (IOError, ValueError):
+    key_info = None
+  if key_info is not None and not os.path.isfile(stored_key):
+    key_info = None
+  if (key_info is not None and 
+      key_info.get('checked', 0) > time.time() - KEY_FRESHNESS):
+    return stored_key
+
+  request = urllib2.Request(key_url)
+  if key_info is not None:
+    if key_info.get('etag'):
+      request.add_header('If-None-Match', key_info['etag'])
+    if key_info.get('last_modified'):
+      request.add_header('If-Modified-Since', key_info['last_modified'])
+  try:
+    url_handle = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    key_data = url_handle.read()
+    key_info = {'etag': url_handle.info().getheader('ETag'),
+                'last_modified': url_handle.info().getheader('Last-Modified')}
+  except urllib2.HTTPError, ex:
+    if key_info is None or ex.code != 304:
+      raise
+    key_data = None
+  except urllib2.URLError:
+    # keep using the stored key if the server can't be reached
+    if key_info is None:
+      raise
+    return stored_key
+
+  key_info['checked'] = time.time()
+  if key_data is not None:
+    (fhandle, temp_file) = tempfile.mkstemp(dir=key_store)
+    os.write(fhandle, key_data)
+    os.close(fhandle)
+    os.rename(temp_file, stored_key)
+  (fhandle, temp_file) = tempfile.mkstemp(dir=key_store)
+  os.write(fhandle, json.dumps(key_info))
+  os.close(fhandle)
+  os.rename(temp_file, stored_key + '.info')
+  return stored_key
+
+def get_cvmfs_key(key_url, temp_dir):
+  """
+  Get a cvmfs key, going through the node key store if possible, and 
+  save it in temp_dir
+  """
+  key_name = urlparse.urlparse(key_url)[2].split('/')[-1]
+  key_store = get_key_store()
+  if key_store is not None:
+    try:
+      shutil.copyfile(fetch_cvmfs_key(key_url, key_store),
+                      os.path.join(temp_dir, key_name))
+      return True
+    except urllib2.URLError:
+      raise
+    except (OSError, IOError):
+      # fall back to downloading the key if the key store isn't usable
+      pass
+  url_handle = urllib2.urlopen(key_url, timeout=DOWNLOAD_TIMEOUT)
+  key_file = open(os.path.join(temp_dir, key_name), 'w')
+  url_data = url_handle.read(2048)
+  while url_data:
+    key_file.write(url_data)
     url_data = url_handle.read(2048)
-    while url_data:
-      key_file.write(url_data)
-      url_data = url_handle.read(2048)
-    key_file.close()
-
-def run_application(temp_dir):
-  """
-  Run specified user application in a parrot environment
-  """
-  job_env = generate_env(temp_dir)
-  get_cvmfs_keys(temp_dir)
-  job_args = ['./parrot/bin/parrot_run', 
-              '-t',
-              os.path.join(temp_dir, 'parrot_cache'),
-              '-r',
-              create_cvmfs_options()]
+  key_file.close()
+  return True
+
+def run_parallel(tasks, max_threads=STAGE_THREADS):
+  """
+  Run a list of (name, function, args) tasks using at most max_threads
+  threads, returns a tuple with a dict of results and a dict with
+  the exceptions raised by failed tasks, both indexed by task name
+  """
+  task_queue = Queue.Queue()
+  for task in tasks:
+    task_queue.put(task)
+  results = {}
+  errors = {}
+
+  def worker():
+    while True:
+      try:
+        (name, function, args) = task_queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[name] = function(*args)
+      except Exception, ex:
+        errors[name] = ex
+
+  threads = []
+  for i in range(min(max_threads, len(tasks))):
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    thread.join()
+  return (results, errors)
+
+def start_cvmfs_warm(temp_dir):
+  """
+  Start a parrot process reading the CVMFS_WARM paths into the job's 
+  parrot cache
+  """
+  command = ['./parrot/bin/parrot_run', 
+             '-t',
+             os.path.join(temp_dir, 'parrot_cache'),
+             '-r',
+             create_cvmfs_options(),
+             '/bin/sh',
+             '-c',
+             CVMFS_WARM_SCRIPT,
+             'sh'] + CVMFS_WARM
+  null_file = open(os.devnull, 'w')
+  try:
+    WARM_PROCESSES.append(subprocess.Popen(command, 
+                                           cwd=temp_dir, 
+                                           env=generate_env(temp_dir),
+                                           stdout=null_file, 
+                                           stderr=null_file,
+                                           preexec_fn=os.setsid))
+    sys.stderr.write("Warming the parrot cache with %d cvmfs paths\n" % 
+                     len(CVMFS_WARM))
+  except OSError, ex:
+    sys.stderr.write("Can't start warming the parrot cache: %s\n" % ex)
+  null_file.close()
+
+def stop_cvmfs_warm():
+  """
+  Stop any parrot processes still warming the cache
+  """
+  for process in WARM_PROCESSES:
+    if process.poll() is None:
+      try:
+        os.killpg(process.pid, signal.SIGTERM)
+      except OSError:
+        pass
+      process.wait()
+
+def warm_after(warm_state, function, *args):
+  """
+  Run a staging task that parrot needs before it can read from cvmfs, 
+  the cache is warmed once the last of these tasks succeeds
+  """
+  result = function(*args)
+  warm_state['lock'].acquire()
+  try:
+    warm_state['pending'] -= 1
+    if not result:
+      warm_state['failed'] = True
+    ready = warm_state['pending'] == 0 and not warm_state['failed']
+  finally:
+    warm_state['lock'].release()
+  if ready:
+    start_cvmfs_warm(warm_state['temp_dir'])
+  return result
+
+def stage_in(temp_dir, debug=False, native=False):
+  """
+  Download parrot, the application and cvmfs keys in parallel, returns
+  True if everything was staged.  Parrot isn't downloaded for jobs
+  running natively.  If there are CVMFS_WARM paths they're read into 
+  the parrot cache as soon as parrot and the keys are ready, while the 
+  application is still downloading.
+  """
+  stage_tasks = []
+  if not native:
+    stage_tasks.append(('parrot', setup_parrot, (temp_dir,)))
+  if APP_URL != '':
+    stage_tasks.append(('application', setup_application, (temp_dir,)))
+  for key_url in get_cvmfs_key_urls():
+    stage_tasks.append((key_url, get_cvmfs_key, (key_url, temp_dir)))
+  if CVMFS_WARM != [] and not native:
+    warm_state = {'pending': len(stage_tasks), 
+                  'failed': False,
+                  'lock': threading.Lock(),
+                  'temp_dir': temp_dir}
+    for i in range(len(stage_tasks)):
+      (name, function, args) = stage_tasks[i]
+      if name == 'application':
+        warm_state['pending'] -= 1
+      else:
+        stage_tasks[i] = (name, warm_after, (warm_state, function) + args)
+  (results, errors) = run_parallel(stage_tasks)
+
+  staged = True
+  if not native and not results.get('parrot'):
+    sys.stderr.write("Can't download parrot binaries, exiting...\n")
+    staged = False
+  if APP_URL != '' and not results.get('application'):
+    sys.stderr.write("Can't download application binaries, exiting...\n")
+    staged = False
+  for key_url in get_cvmfs_key_urls():
+    if not results.get(key_url):
+      sys.stderr.write("Can't download CVMFS key from %s, " \
+                       "exiting...\n" % key_url)
+      staged = False
+  if debug:
+    for name in errors:
+      sys.stderr.write("Error while staging %s: %s\n" % (name, errors[name]))
+  return staged
+
+def run_application(temp_dir, native=False):
+  """
+  Run specified user application in a parrot environment or directly
+  if it runs natively
+  """
+  job_env = generate_env(temp_dir, native)
+  if native:
+    job_args = []
+  else:
+    job_args = ['./parrot/bin/parrot_run', 
+                '-t',
+                os.path.join(temp_dir, 'parrot_cache'),
+                '-r',
+                create_cvmfs_options()]
   job_args.append(JOB_SCRIPT)
   if JOB_ARGS != "":
     job_args.extend(JOB_ARGS.split(' '))
@@ -176,6 +444,12 @@ def main():
                     help="Preserver working directory for debugging",
                     action="store_true", 
                     default=False)
+  parser.add_option("--force-parrot", 
+                    dest="force_parrot",
+                    help="Run the application under parrot even if " \
+                         "it could run natively",
+                    action="store_true", 
+                    default=False)
   (options, args) = parser.parse_args()  
   try:
     temp_dir = tempfile.mkdtemp()
@@ -189,14 +463,17 @@ def main():
       sys.stderr.write("Can't create user proxy, exiting...\n")
       sys.exit(1)
    
-  if not setup_parrot(temp_dir):
-    sys.stderr.write("Can't download parrot binaries, exiting...\n")
+  native = not options.force_parrot and not parrot_needed()
+  if native:
+    sys.stderr.write("CVMFS repositories are mounted on the node, " \
+                     "running application natively\n")
+  else:
+    sys.stderr.write("Running application under parrot\n")
+  if not stage_in(temp_dir, options.debug, native):
+    stop_cvmfs_warm()
     sys.exit(1)
-  if APP_URL != '':
-    if not setup_application(temp_dir):       
-      sys.stderr.write("Can't download application binaries, exiting...\n")
-      sys.exit(1)
-  exit_code = run_application(temp_dir)
+  exit_code = run_application(temp_dir, native)
+  stop_cvmfs_warm()
   if exit_code != 0:
     sys.stderr.write("Application exited with error\n")
     if options.debug:
@@ -21,7 +21,8 @@
 # limitations under the License.
 
 import sys, os, subprocess, shutil, optparse, platform, tempfile, urllib2, tarfile
-import urlparse, time, re
+import urlparse, time, re, threading, Queue, socket, httplib, fcntl, hashlib, json
+import zlib, shlex, math, glob, gzip, collections, signal
 
 TICKET_CONTENTS = """%%%TICKET%%%
 """
@@ -33,7 +34,167 @@ PARROT_URL = '%%%PARROT_URL%%%'
 JOB_SCRIPT = '%%%JOB_SCRIPT%%%'
 JOB_ARGS = %%%JOB_ARGS%%%
 CVMFS_INFO = %%%CVMFS_INFO%%%
+CACHE_DIR = '%%%CACHE_DIR%%%'
+CACHE_LIMIT = %%%CACHE_LIMIT%%%
+# seconds a cached url is used without checking the server for changes
+CACHE_FRESHNESS = 300
+SHARED_PARROT_CACHE = %%%SHARED_PARROT_CACHE%%%
+# quota_limit in MB given to cvmfs repositories without one when the 
+# parrot cache is shared, cvmfs keeps its part of the cache within it
+PARROT_CACHE_QUOTA = 2000
+# other files in the shared parrot cache are removed once they haven't 
+# been used for PARROT_CACHE_MAX_AGE seconds, or least recently used 
+# first once they take more than PARROT_FILES_LIMIT MB.  The cache is 
+# checked at most once every PARROT_CACHE_CLEAN_INTERVAL seconds
+PARROT_CACHE_MAX_AGE = 7 * 86400
+PARROT_FILES_LIMIT = 1024
+PARROT_CACHE_CLEAN_INTERVAL = 3600
 VERSION = '0.10'
+# size of reads when downloading and extracting tarballs
+DOWNLOAD_BUFSIZE = 1024 * 1024
+# maximum number of downloads to run at the same time when staging in
+STAGE_THREADS = 4
+# seconds a stored cvmfs key is used without checking the server
+KEY_FRESHNESS = 3600
+# seconds to wait on a mirror before giving up on a request
+DOWNLOAD_TIMEOUT = 60
+# number of passes through the mirror list before a download fails
+DOWNLOAD_RETRIES = 3
+# downloads slower than this (bytes/s) after HEDGE_GRACE seconds are
+# hedged with a request to the next mirror made in the background, the
+# download switches to it if it sends its first block faster
+HEDGE_THRESHOLD = 512 * 1024
+HEDGE_GRACE = 10
+HEDGE_CHECK_BYTES = 256 * 1024
+# application bundles made by skeleton_key --make-bundle end with 
+# BUNDLE_SUFFIX and start with BUNDLE_MAGIC and the size of the member table
+BUNDLE_SUFFIX = '.skb'
+BUNDLE_MAGIC = 'SKBUNDLE1\n'
+# bytes requested when reading the start of a bundle, enough for the 
+# member table of most bundles
+BUNDLE_HEAD_SIZE = 64 * 1024
+# bundle members less than BUNDLE_MERGE_GAP bytes apart are fetched with 
+# one request as long as the request is under BUNDLE_MAX_RANGE bytes
+BUNDLE_MERGE_GAP = 64 * 1024
+BUNDLE_MAX_RANGE = 16 * 1024 * 1024
+# chunk manifests published by skeleton_key --publish-chunks end with 
+# MANIFEST_SUFFIX, the chunks are in a chunks directory next to them
+MANIFEST_SUFFIX = '.skm'
+# threads fetching data while the application runs and the event telling
+# them to stop once it's finished
+BACKGROUND_THREADS = []
+BACKGROUND_STOP = threading.Event()
+# record of the mirrors used and bytes transferred for each download
+TRANSFERS = []
+# pids of the application processes that are running, the resource 
+# sampler only follows processes started by these
+APP_PIDS = []
+# destination for the job's timing record: a file, - for stderr or
+# chirp:<directory> to write it to the chirp server
+TIMING_LOG = '%%%TIMING_LOG%%%'
+# wall clock start and end of each timed phase of the job
+PHASES = {}
+PHASE_LOCK = threading.Lock()
+# phase being timed in each thread, used to attribute downloads to phases
+PHASE_STATE = threading.local()
+JOB_START = time.time()
+# other information about the job added to its timing record
+JOB_INFO = {}
+# file with the arguments for each task to run in pilot mode and the 
+# number of threads each task gets
+TASK_FILE = '%%%TASK_FILE%%%'
+TASK_THREADS = %%%TASK_THREADS%%%
+# environment variables used to limit the threads used by a task
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 
+                    'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+# patterns for the outputs the job leaves in its working directory that 
+# are copied to STAGE_OUT_DIR on the chirp server once it finishes
+STAGE_OUT = %%%STAGE_OUT%%%
+STAGE_OUT_DIR = '%%%STAGE_OUT_DIR%%%'
+STAGE_OUT_COMPRESS = %%%STAGE_OUT_COMPRESS%%%
+# if STAGE_OUT_BUNDLE is set outputs smaller than STAGE_OUT_SMALL are 
+# copied in tarballs of up to STAGE_OUT_BUNDLE_SIZE bytes named 
+# outputs-<job id>-<n>.tar, otherwise every output is copied as is
+STAGE_OUT_BUNDLE = %%%STAGE_OUT_BUNDLE%%%
+STAGE_OUT_SMALL = 1024 * 1024
+STAGE_OUT_BUNDLE_SIZE = 64 * 1024 * 1024
+# number of copies to the chirp server running at the same time and 
+# attempts made for each copy
+STAGE_OUT_STREAMS = 4
+STAGE_OUT_RETRIES = 3
+# files under the chirp export copied to local scratch before the job 
+# starts, parrot redirects reads of them to the copies using the mount
+# list in PREFETCH_MOUNTS
+PREFETCH = %%%PREFETCH%%%
+PREFETCH_MOUNTS = 'prefetch.mounts'
+PREFETCH_STREAMS = 8
+# chirp servers sharing the export, each job prefers the server its id 
+# hashes highest with and moves on to the next if it can't connect within
+# CHIRP_PROBE_TIMEOUT seconds
+CHIRP_SERVERS = %%%CHIRP_SERVERS%%%
+CHIRP_PROBE_TIMEOUT = 5
+# seconds between samples of the cpu, memory, io and open files used by 
+# the application's processes, 0 turns sampling off.  The last 
+# SAMPLE_BUFFER samples are kept and reduced to SAMPLE_TIMELINE points 
+# for the timing record.
+SAMPLE_INTERVAL = %%%SAMPLE_INTERVAL%%%
+SAMPLE_BUFFER = 3600
+SAMPLE_TIMELINE = 60
+# web proxies are probed for at most PROXY_PROBE_TIMEOUT seconds and 
+# ranked by latency, the ranking is shared by jobs on the node for 
+# PROXY_CACHE_TIME seconds
+PROXY_PROBE_TIMEOUT = 5
+PROXY_CACHE_TIME = 300
+PROXY_RECORD = 'proxies.json'
+PROXY_LOCK = threading.Lock()
+# cvmfs paths read into the parrot cache by a background parrot process 
+# while the application is staged, directories are read recursively and
+# paths starting with @ are manifests listing the paths to read, 
+# CVMFS_WARM_READERS files are read at a time
+CVMFS_WARM = %%%CVMFS_WARM%%%
+CVMFS_WARM_READERS = 8
+CVMFS_WARM_SCRIPT = """
+for path in "$@"; do
+  case "$path" in
+    @*) cat "${path#@}" ;;
+    *) find "$path" -type f ;;
+  esac
+done | xargs -d '\\n' -P %d -n 16 cat > /dev/null
+""" % CVMFS_WARM_READERS
+
+def record_transfer(url, served_by, transferred):
+  """
+  Record the mirrors used and bytes transferred for a download along
+  with the phase it was made in
+  """
+  TRANSFERS.append({'url': url,
+                    'served_by': served_by,
+                    'bytes': transferred,
+                    'phase': getattr(PHASE_STATE, 'phase', None)})
+
+def timed(phase, function, *args):
+  """
+  Call function with args and record the time taken as part of phase,
+  phases timed more than once cover the span from the first start to
+  the last finish
+  """
+  previous = getattr(PHASE_STATE, 'phase', None)
+  PHASE_STATE.phase = phase
+  start = time.time()
+  try:
+    return function(*args)
+  finally:
+    end = time.time()
+    PHASE_STATE.phase = previous
+    PHASE_LOCK.acquire()
+    try:
+      if phase in PHASES:
+        PHASES[phase] = (min(PHASES[phase][0], start),
+                         max(PHASES[phase][1], end))
+      else:
+        PHASES[phase] = (start, end)
+    finally:
+      PHASE_LOCK.release()
 
 def write_ticket(directory):
   """
@@ -77,130 +238,2127 @@ def ticket_valid():
     return True
   expiration = time.strptime(match.group(1),
                              "%a %b %d %H:%M:%S %Y")
-  return time.time() > time.mktime(expiration)
+  return time.time() < time.mktime(expiration)
 
-def download_tarball(url, path):
-  """Download a tarball from a given url and extract it to specified path"""
+class HashingReader(object):
+  """
+  File-like wrapper around an open url that computes the sha1 digest of
+  the data read through it
+  """
+  def __init__(self, handle):
+    self.handle = handle
+    self.digest = hashlib.sha1()
 
-  (fhandle, download_file) = tempfile.mkstemp(dir=path)
-  url_handle = urllib2.urlopen(url)
-  url_data = url_handle.read(2048)
-  while url_data:
-    os.write(fhandle, url_data)
-    url_data = url_handle.read(2048)
-  os.close(fhandle)
-  downloaded_tarfile = tarfile.open(download_file)
-  cur_dir = os.getcwd()
-  os.chdir(path)
-  extract_path = os.path.join(path,
-                              downloaded_tarfile.getmembers()[0].name)
-  for tar_info in downloaded_tarfile:
-    downloaded_tarfile.extract(tar_info)
-  os.unlink(download_file)
-  os.chdir(cur_dir)
+  def read(self, size=-1):
+    data = self.handle.read(size)
+    self.digest.update(data)
+    return data
+
+  def hexdigest(self):
+    """
+    Read any data remaining after the end of the archive and return the
+    digest of the complete body
+    """
+    while self.read(DOWNLOAD_BUFSIZE):
+      pass
+    return self.digest.hexdigest()
+
+def extract_stream(stream, path):
+  """
+  Extract a (compressed) tar stream to path while it's being read and
+  return the path of the first member extracted
+  """
+  tar_stream = tarfile.open(fileobj=stream, 
+                            mode='r|*', 
+                            bufsize=DOWNLOAD_BUFSIZE)
+  extract_path = None
+  for tar_info in tar_stream:
+    if extract_path is None:
+      extract_path = os.path.join(path, tar_info.name)
+    tar_stream.extract(tar_info, path)
+  tar_stream.close()
+  return extract_path
+
+def get_mirrors(urls):
+  """
+  Split a comma or whitespace separated list of mirror urls
+  """
+  if isinstance(urls, list):
+    return urls
+  return [url for url in re.split(r'[,\s]+', urls) if url != '']
+
+class MirrorReader(object):
+  """
+  File-like object that reads a file from a list of mirrors, resuming
+  with range requests when a transfer fails or gets cut off and hedging
+  slow transfers with a request to the next mirror
+  """
+  def __init__(self, mirrors, headers=None):
+    self.mirrors = mirrors
+    self.headers = headers or {}
+    self.offset = 0
+    self.length = None
+    self.handle = None
+    self.mirror = None
+    self.pending = ''
+    self.failed = set()
+    self.hedged = set()
+    self.hedge = None
+    self.served_by = []
+    self.response_headers = None
+    # resumes in a row that didn't get any data
+    self.stalls = 0
+    self.open_mirror(0)
+
+  def request(self, index, offset=None):
+    """
+    Request the file from a mirror starting at offset, or the current
+    offset if it isn't given
+    """
+    if offset is None:
+      offset = self.offset
+    request = urllib2.Request(self.mirrors[index])
+    if offset == 0:
+      for header in self.headers:
+        request.add_header(header, self.headers[header])
+    else:
+      request.add_header('Range', "bytes=%d-" % offset)
+    handle = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    if offset == 0:
+      if self.response_headers is None:
+        self.response_headers = handle.info()
+      if handle.info().getheader('Content-Length'):
+        self.length = int(handle.info().getheader('Content-Length'))
+      return handle
+    content_range = handle.info().getheader('Content-Range')
+    if handle.code != 206 or content_range is None:
+      handle.close()
+      self.failed.add(index)
+      raise IOError("%s doesn't support range requests" % self.mirrors[index])
+    total = content_range.split('/')[-1]
+    if (total != '*' and self.length is not None and
+        int(total) != self.length):
+      handle.close()
+      raise IOError("%s has a different version of the file" %
+                    self.mirrors[index])
+    return handle
+
+  def open_mirror(self, start):
+    """
+    Open the first mirror that answers, trying mirrors in order
+    beginning with start and backing off between passes
+    """
+    last_error = None
+    for attempt in range(DOWNLOAD_RETRIES):
+      for i in range(len(self.mirrors)):
+        index = (start + i) % len(self.mirrors)
+        if index in self.failed:
+          continue
+        try:
+          self.handle = self.request(index)
+        except urllib2.HTTPError, ex:
+          if ex.code == 304 and self.offset == 0:
+            raise
+          if ex.code < 500:
+            # missing or forbidden files won't appear on retries
+            self.failed.add(index)
+          last_error = ex
+          continue
+        except (IOError, socket.error, httplib.HTTPException), ex:
+          last_error = ex
+          continue
+        self.mirror = index
+        self.served_by.append(self.mirrors[index])
+        self.started = time.time()
+        self.transferred = 0
+        return
+      if len(self.failed) == len(self.mirrors):
+        break
+      time.sleep(2 ** attempt)
+    if last_error is None:
+      last_error = IOError("No usable mirrors for %s" % self.mirrors[0])
+    if not isinstance(last_error, (urllib2.URLError, socket.error, 
+                                   httplib.HTTPException)):
+      # report mirror failures as network errors so callers don't mistake
+      # them for local problems
+      last_error = urllib2.URLError(last_error)
+    raise last_error
+
+  def fetch_hedge(self, hedge):
+    """
+    Request the rest of the file from the hedge mirror and read its
+    first block, run in a thread while the current transfer continues
+    """
+    try:
+      hedge['handle'] = self.request(hedge['index'], hedge['offset'])
+      hedge['data'] = hedge['handle'].read(DOWNLOAD_BUFSIZE)
+    except (IOError, socket.error, httplib.HTTPException):
+      hedge['data'] = ''
+    hedge['done'].set()
+
+  def maybe_hedge(self):
+    """
+    Request the rest of the file from the next mirror in the background 
+    if the current transfer is too slow
+    """
+    if self.hedge is not None:
+      return
+    elapsed = time.time() - self.started
+    if (len(self.mirrors) < 2 or elapsed < HEDGE_GRACE or
+        self.transferred / elapsed >= HEDGE_THRESHOLD):
+      return
+    index = (self.mirror + 1) % len(self.mirrors)
+    if index in self.hedged or index in self.failed:
+      return
+    self.hedged.add(index)
+    self.hedge = {'index': index, 'offset': self.offset, 
+                  'start': time.time(), 'done': threading.Event(),
+                  'handle': None, 'data': ''}
+    thread = threading.Thread(target=self.fetch_hedge, args=(self.hedge,))
+    thread.setDaemon(True)
+    thread.start()
+
+  def check_hedge(self):
+    """
+    Switch to the hedge mirror once it has answered if it sent its first
+    block before the current transfer got past it
+    """
+    hedge = self.hedge
+    if hedge is None or not hedge['done'].isSet():
+      return
+    self.hedge = None
+    end = hedge['offset'] + len(hedge['data'])
+    if self.offset >= end:
+      # the current transfer kept up or the hedge failed
+      if hedge['handle'] is not None:
+        hedge['handle'].close()
+      return
+    self.handle.close()
+    self.handle = hedge['handle']
+    self.mirror = hedge['index']
+    self.served_by.append(self.mirrors[hedge['index']])
+    self.started = hedge['start']
+    self.transferred = len(hedge['data'])
+    self.pending = hedge['data'][self.offset - hedge['offset']:]
+    self.offset = end
+
+  def read(self, size=-1):
+    if not self.pending:
+      self.check_hedge()
+    if not self.pending:
+      self.maybe_hedge()
+    if self.pending:
+      if size < 0:
+        size = len(self.pending)
+      data = self.pending[:size]
+      self.pending = self.pending[size:]
+      return data
+    if size < 0 or size > HEDGE_CHECK_BYTES:
+      # keep reads short enough to notice slow transfers quickly
+      size = HEDGE_CHECK_BYTES
+    while True:
+      try:
+        data = self.handle.read(size)
+      except (IOError, socket.error, httplib.HTTPException):
+        data = None
+      if data:
+        self.offset += len(data)
+        self.transferred += len(data)
+        self.stalls = 0
+        return data
+      if data == '' and (self.length is None or self.offset >= self.length):
+        return data
+      # transfer failed or was cut off, resume where it stopped and stop
+      # using mirrors that keep sending nothing
+      self.handle.close()
+      self.stalls += 1
+      if self.stalls >= DOWNLOAD_RETRIES:
+        self.failed.add(self.mirror)
+        self.stalls = 0
+        if len(self.failed) == len(self.mirrors):
+          raise urllib2.URLError("No mirror sent the rest of %s" % 
+                                 self.mirrors[0])
+      self.open_mirror(self.mirror)
+
+  def close(self):
+    if self.hedge is not None and self.hedge['done'].isSet():
+      if self.hedge['handle'] is not None:
+        self.hedge['handle'].close()
+    if self.handle is not None:
+      self.handle.close()
+    record_transfer(self.mirrors[0], self.served_by, self.offset)
+
+def download_tarball(urls, path):
+  """Download a tarball from a list of mirrors and extract it to specified path"""
+
+  url_handle = MirrorReader(get_mirrors(urls))
+  extract_path = extract_stream(url_handle, path)
+  url_handle.close()
   return extract_path
 
-def setup_application(directory):
+def get_node_dir():
+  """
+  Get the per user directory on the node used for data shared between jobs
+  """
+  if CACHE_DIR != '':
+    return CACHE_DIR
+  base_dir = os.environ.get('OSG_WN_TMP', tempfile.gettempdir())
+  return os.path.join(base_dir, "skeletonkey-cache-%s" % os.getuid())
+
+def get_cache_dir():
+  """
+  Get the node local cache directory, creating it if needed, returns None
+  if the cache can't be used
+  """
+  if CACHE_LIMIT == 0:
+    return None
+  cache_dir = get_node_dir()
+  try:
+    for subdir in ('urls', 'objects', 'locks', 'members', 'chunks'):
+      if not os.path.isdir(os.path.join(cache_dir, subdir)):
+        os.makedirs(os.path.join(cache_dir, subdir), 0700)
+  except OSError:
+    return None
+  return cache_dir
+
+def lock_file(path, exclusive=True, blocking=True):
+  """
+  Lock path using flock, returns a file descriptor that needs to be
+  passed to unlock_file or None if the lock couldn't be acquired
+  """
+  fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+  if exclusive:
+    flags = fcntl.LOCK_EX
+  else:
+    flags = fcntl.LOCK_SH
+  if not blocking:
+    flags |= fcntl.LOCK_NB
+  try:
+    fcntl.flock(fd, flags)
+  except IOError:
+    os.close(fd)
+    return None
+  return fd
+
+def unlock_file(fd):
+  """
+  Release a lock obtained using lock_file
+  """
+  fcntl.flock(fd, fcntl.LOCK_UN)
+  os.close(fd)
+
+def read_record(path):
+  """
+  Read a json cache record, returns None if it's missing or corrupt
+  """
+  try:
+    return json.loads(open(path).read())
+  except (IOError, ValueError):
+    return None
+
+def write_record(path, record):
+  """
+  Atomically write a json cache record
+  """
+  (fhandle, temp_file) = tempfile.mkstemp(dir=os.path.dirname(path))
+  os.write(fhandle, json.dumps(record))
+  os.close(fhandle)
+  os.rename(temp_file, path)
+
+def tree_size(path):
+  """
+  Get the number of bytes used by files in a directory tree
+  """
+  size = 0
+  for root, dirs, files in os.walk(path):
+    for file_name in files:
+      file_path = os.path.join(root, file_name)
+      if not os.path.islink(file_path):
+        size += os.path.getsize(file_path)
+  return size
+
+def link_cached(source_path, dest_path):
+  """
+  Hardlink a file in the node cache to dest_path, copying it if it can't
+  be linked.  The cached file is made read-only first so that a job 
+  writing to it fails instead of changing it for every job on the node
+  """
+  mode = os.stat(source_path).st_mode
+  if mode & 0222:
+    os.chmod(source_path, mode & 07777 & ~0222)
+  try:
+    os.link(source_path, dest_path)
+  except OSError:
+    shutil.copy2(source_path, dest_path)
+
+def clone_tree(source, dest):
+  """
+  Recreate the tree at source in dest using read-only hardlinks, falling
+  back to copying if files can't be linked (e.g. dest is on another 
+  filesystem)
+  """
+  for root, dirs, files in os.walk(source):
+    dest_root = os.path.join(dest, os.path.relpath(root, source))
+    if not os.path.isdir(dest_root):
+      os.makedirs(dest_root)
+    for name in dirs + files:
+      source_path = os.path.join(root, name)
+      dest_path = os.path.join(dest_root, name)
+      if os.path.islink(source_path):
+        os.symlink(os.readlink(source_path), dest_path)
+      elif os.path.isdir(source_path):
+        continue
+      else:
+        link_cached(source_path, dest_path)
+
+def evict_cache(cache_dir, keep):
+  """
+  Remove least recently used objects, bundle members and chunks until the
+  cache is below CACHE_LIMIT, objects being cloned by other jobs and the 
+  object given by keep are skipped
+  """
+  global_lock = lock_file(os.path.join(cache_dir, 'lock'))
+  try:
+    # clean up after jobs that died while downloading or evicting
+    for name in os.listdir(cache_dir):
+      stale_path = os.path.join(cache_dir, name)
+      if (name.startswith('tmp') and
+          os.path.getmtime(stale_path) < time.time() - 86400):
+        if os.path.isdir(stale_path):
+          shutil.rmtree(stale_path, ignore_errors=True)
+        else:
+          os.unlink(stale_path)
+    objects = []
+    total_size = 0
+    object_dir = os.path.join(cache_dir, 'objects')
+    for name in os.listdir(object_dir):
+      record = read_record(os.path.join(object_dir, name, '.sk_object'))
+      if record is None:
+        continue
+      last_used = os.path.getmtime(os.path.join(object_dir, name))
+      objects.append((last_used, name, record['size']))
+      total_size += record['size']
+    for store in ('members', 'chunks'):
+      store_dir = os.path.join(cache_dir, store)
+      if not os.path.isdir(store_dir):
+        continue
+      for name in os.listdir(store_dir):
+        try:
+          store_stat = os.stat(os.path.join(store_dir, name))
+        except OSError:
+          continue
+        objects.append((store_stat.st_mtime, 
+                        os.path.join(store, name),
+                        store_stat.st_size))
+        total_size += store_stat.st_size
+    objects.sort()
+    for last_used, name, size in objects:
+      if total_size <= CACHE_LIMIT * 1024 * 1024:
+        break
+      if name == keep:
+        continue
+      if name.startswith('members') or name.startswith('chunks'):
+        # jobs using members have their own hardlink to them and jobs 
+        # missing a chunk fetch it again
+        os.unlink(os.path.join(cache_dir, name))
+        total_size -= size
+        continue
+      object_lock = lock_file(os.path.join(cache_dir, 'locks', name),
+                              blocking=False)
+      if object_lock is None:
+        continue
+      try:
+        trash_dir = tempfile.mkdtemp(dir=cache_dir)
+        os.rename(os.path.join(object_dir, name),
+                  os.path.join(trash_dir, name))
+        shutil.rmtree(trash_dir)
+        total_size -= size
+      finally:
+        unlock_file(object_lock)
+  finally:
+    unlock_file(global_lock)
+
+def fetch_object(mirrors, cache_dir):
+  """
+  Make sure the contents of the file on mirrors are extracted in the cache,
+  returns a tuple with the content hash and top level directory of the
+  tarball
+  """
+  url = mirrors[0]
+  record_file = os.path.join(cache_dir, 'urls', hashlib.sha1(url).hexdigest())
+  record = read_record(record_file)
+  if (record is not None and
+      not os.path.isdir(os.path.join(cache_dir, 'objects', record['hash']))):
+    record = None
+  if record is not None and record.get('checked', 0) > time.time() - CACHE_FRESHNESS:
+    record_transfer(url, ['cache'], 0)
+    return (record['hash'], record['top'])
+  headers = {}
+  if record is not None:
+    if record.get('etag'):
+      headers['If-None-Match'] = record['etag']
+    if record.get('last_modified'):
+      headers['If-Modified-Since'] = record['last_modified']
+  try:
+    url_handle = MirrorReader(mirrors, headers)
+  except urllib2.HTTPError, ex:
+    if record is None or ex.code != 304:
+      raise
+    record['checked'] = time.time()
+    write_record(record_file, record)
+    record_transfer(url, ['cache'], 0)
+    return (record['hash'], record['top'])
+  except (IOError, socket.error, httplib.HTTPException):
+    # use the cached copy if none of the mirrors can be reached
+    if record is None:
+      raise
+    record_transfer(url, ['cache'], 0)
+    return (record['hash'], record['top'])
+
+  extract_dir = tempfile.mkdtemp(dir=cache_dir)
+  try:
+    reader = HashingReader(url_handle)
+    top = os.path.relpath(extract_stream(reader, extract_dir), extract_dir)
+    digest = reader.hexdigest()
+    object_dir = os.path.join(cache_dir, 'objects', digest)
+    if os.path.isdir(object_dir):
+      # same contents already cached under another url or version
+      top = read_record(os.path.join(object_dir, '.sk_object'))['top']
+    else:
+      write_record(os.path.join(extract_dir, '.sk_object'),
+                   {'top': top, 'size': tree_size(extract_dir)})
+      os.rename(extract_dir, object_dir)
+  finally:
+    url_handle.close()
+    if os.path.isdir(extract_dir):
+      shutil.rmtree(extract_dir, ignore_errors=True)
+  write_record(record_file,
+               {'url': url,
+                'hash': digest,
+                'top': top,
+                'checked': time.time(),
+                'etag': url_handle.response_headers.getheader('ETag'),
+                'last_modified': url_handle.response_headers.getheader('Last-Modified')})
+  return (digest, top)
+
+def cached_tarball(mirrors, path, cache_dir):
+  """
+  Get a tarball from the node cache, downloading it if needed, and place
+  a read-only hardlinked copy of everything extracted from it in path
+  """
+  url_lock = lock_file(os.path.join(cache_dir,
+                                    'locks',
+                                    "url-%s" % hashlib.sha1(mirrors[0]).hexdigest()))
+  try:
+    (digest, top) = fetch_object(mirrors, cache_dir)
+    object_lock = lock_file(os.path.join(cache_dir, 'locks', digest),
+                            exclusive=False)
+  finally:
+    unlock_file(url_lock)
+  try:
+    object_dir = os.path.join(cache_dir, 'objects', digest)
+    os.utime(object_dir, None)
+    # tarballs can have several top level entries, clone all of them
+    for name in os.listdir(object_dir):
+      if name == '.sk_object':
+        continue
+      source_path = os.path.join(object_dir, name)
+      dest_path = os.path.join(path, name)
+      if os.path.islink(source_path):
+        os.symlink(os.readlink(source_path), dest_path)
+      elif os.path.isdir(source_path):
+        clone_tree(source_path, dest_path)
+      else:
+        link_cached(source_path, dest_path)
+  finally:
+    unlock_file(object_lock)
+  evict_cache(cache_dir, digest)
+  return os.path.join(path, top)
+
+def stage_tarball(urls, path, cache_dir=None):
+  """
+  Extract tarball from a list of mirrors into path, going through the
+  node cache if one is available
+  """
+  mirrors = get_mirrors(urls)
+  if cache_dir is not None:
+    try:
+      return cached_tarball(mirrors, path, cache_dir)
+    except (urllib2.URLError, socket.error, httplib.HTTPException):
+      raise
+    except (OSError, IOError):
+      # fall back to a direct download if the cache isn't usable
+      pass
+  return download_tarball(mirrors, path)
+
+def open_range(mirror, start, end, total=None):
+  """
+  Request bytes start to end of the file at mirror, returns a tuple with
+  the response and the size of the whole file
+  """
+  request = urllib2.Request(mirror)
+  request.add_header('Range', "bytes=%d-%d" % (start, end))
+  handle = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+  content_range = handle.info().getheader('Content-Range')
+  if handle.code != 206 or content_range is None:
+    handle.close()
+    raise IOError("%s doesn't support range requests" % mirror)
+  size = int(content_range.split('/')[-1])
+  if total is not None and size != total:
+    handle.close()
+    raise IOError("%s has a different version of the bundle" % mirror)
+  return (handle, size)
+
+def read_bundle_index(mirrors):
+  """
+  Read the member table at the start of an application bundle, returns
+  the table along with the mirror that answered
+  """
+  last_error = None
+  for attempt in range(DOWNLOAD_RETRIES):
+    for mirror in mirrors:
+      try:
+        (handle, total) = open_range(mirror, 0, BUNDLE_HEAD_SIZE - 1)
+        data = handle.read()
+        handle.close()
+        if not data.startswith(BUNDLE_MAGIC):
+          raise IOError("%s isn't an application bundle" % mirror)
+        header_size = len(BUNDLE_MAGIC) + 16
+        index_size = int(data[len(BUNDLE_MAGIC):header_size], 16)
+        if len(data) < header_size + index_size:
+          (handle, total) = open_range(mirror, 
+                                       len(data), 
+                                       header_size + index_size - 1,
+                                       total)
+          data += handle.read()
+          handle.close()
+        index = json.loads(data[header_size:header_size + index_size])
+      except (IOError, socket.error, httplib.HTTPException, ValueError), ex:
+        last_error = ex
+        continue
+      index['data_start'] = header_size + index_size
+      index['total'] = total
+      index['bytes'] = len(data)
+      return (index, mirror)
+    time.sleep(2 ** attempt)
+  raise last_error
+
+def group_members(members):
+  """
+  Group bundle members stored close to each other so that each group
+  can be fetched with a single range request
+  """
+  groups = []
+  for member in sorted(members, key=lambda member: member['offset']):
+    if groups != []:
+      last = groups[-1][-1]
+      gap = member['offset'] - (last['offset'] + last['length'])
+      span = member['offset'] + member['length'] - groups[-1][0]['offset']
+      if gap <= BUNDLE_MERGE_GAP and span <= BUNDLE_MAX_RANGE:
+        groups[-1].append(member)
+        continue
+    groups.append([member])
+  return groups
+
+def member_path(path, member):
+  """
+  Get the location of a bundle member in path, refusing names that 
+  would end up outside of path
+  """
+  name = os.path.normpath(member['name'])
+  if os.path.isabs(name) or name.startswith('..'):
+    raise IOError("Bad member name in bundle: %s" % member['name'])
+  return os.path.join(path, name)
+
+def store_member(path, member_store, digest):
+  """
+  Add the bundle member at path to the node's member store, copying it 
+  if it can't be hardlinked
+  """
+  stored_member = os.path.join(member_store, digest)
+  try:
+    os.link(path, stored_member)
+    return
+  except OSError:
+    if os.path.exists(stored_member):
+      return
+  try:
+    (fhandle, temp_file) = tempfile.mkstemp(dir=member_store)
+    os.close(fhandle)
+    shutil.copy2(path, temp_file)
+    os.rename(temp_file, stored_member)
+  except (OSError, IOError):
+    pass
+
+def extract_members(handle, index, members, path, member_store):
+  """
+  Extract the members in a group from a range response, members are 
+  removed from the list as they're written, returns the number of bytes 
+  read
+  """
+  position = members[0]['offset']
+  transferred = 0
+  while members != []:
+    member = members[0]
+    while position < member['offset']:
+      data = handle.read(min(member['offset'] - position, DOWNLOAD_BUFSIZE))
+      if not data:
+        raise IOError("Bundle transfer cut off")
+      position += len(data)
+      transferred += len(data)
+    dest = member_path(path, member)
+    (fhandle, temp_file) = tempfile.mkstemp(dir=os.path.dirname(dest))
+    try:
+      if member['compressed']:
+        decompressor = zlib.decompressobj()
+      checksum = hashlib.sha1()
+      remaining = member['length']
+      while remaining > 0:
+        data = handle.read(min(remaining, DOWNLOAD_BUFSIZE))
+        if not data:
+          raise IOError("Bundle transfer cut off")
+        remaining -= len(data)
+        transferred += len(data)
+        if member['compressed']:
+          data = decompressor.decompress(data)
+        checksum.update(data)
+        os.write(fhandle, data)
+      if member['compressed']:
+        data = decompressor.flush()
+        checksum.update(data)
+        os.write(fhandle, data)
+      os.close(fhandle)
+      fhandle = None
+      if checksum.hexdigest() != member['sha1']:
+        raise IOError("Checksum mismatch for %s in bundle" % member['name'])
+      if member_store is not None:
+        # the member is shared with the store, keep it read-only
+        os.chmod(temp_file, member['mode'] & ~0222)
+        store_member(temp_file, member_store, member['sha1'])
+      else:
+        os.chmod(temp_file, member['mode'])
+      os.rename(temp_file, dest)
+    finally:
+      if fhandle is not None:
+        os.close(fhandle)
+      if os.path.exists(temp_file):
+        os.unlink(temp_file)
+    position += member['length']
+    members.pop(0)
+  return transferred
+
+def fetch_members(mirrors, index, members, path, member_store):
+  """
+  Fetch a group of bundle members with range requests and extract them
+  into path, trying each mirror in turn if a request fails, returns a
+  tuple with the bytes transferred and the mirrors used
+  """
+  members = list(members)
+  transferred = 0
+  served_by = []
+  last_error = None
+  for attempt in range(DOWNLOAD_RETRIES):
+    for mirror in mirrors:
+      start = index['data_start'] + members[0]['offset']
+      end = (index['data_start'] + members[-1]['offset'] + 
+             members[-1]['length'] - 1)
+      try:
+        (handle, total) = open_range(mirror, start, end, index['total'])
+        try:
+          served_by.append(mirror)
+          transferred += extract_members(handle, index, members, 
+                                         path, member_store)
+        finally:
+          handle.close()
+        return (transferred, served_by)
+      except (IOError, socket.error, httplib.HTTPException), ex:
+        last_error = ex
+        continue
+    time.sleep(2 ** attempt)
+  raise last_error
+
+def fetch_bundle_members(mirrors, index, members, path, member_store):
+  """
+  Fetch bundle members in parallel, returns a tuple with the bytes 
+  transferred and the mirrors used
+  """
+  tasks = []
+  for group in group_members(members):
+    tasks.append((len(tasks), fetch_members, 
+                  (mirrors, index, group, path, member_store)))
+  (results, errors) = run_parallel(tasks)
+  if errors != {}:
+    raise errors.values()[0]
+  transferred = 0
+  served_by = set()
+  for (group_bytes, group_mirrors) in results.values():
+    transferred += group_bytes
+    served_by.update(group_mirrors)
+  return (transferred, served_by)
+
+def stage_bundle(urls, path, cache_dir=None):
+  """
+  Set up an application bundle in path, fetching the members with range 
+  requests in parallel, members already in the node cache are hardlinked
+  instead of being fetched.
+  """
+  mirrors = get_mirrors(urls)
+  (index, mirror) = read_bundle_index(mirrors)
+  member_store = None
+  if cache_dir is not None:
+    member_store = os.path.join(cache_dir, 'members')
+  missing = []
+  for member in index['members']:
+    dest = member_path(path, member)
+    if member['type'] == 'dir':
+      if not os.path.isdir(dest):
+        os.makedirs(dest)
+      os.chmod(dest, member['mode'])
+      continue
+    if not os.path.isdir(os.path.dirname(dest)):
+      os.makedirs(os.path.dirname(dest))
+    if member['type'] == 'link':
+      os.symlink(member['target'], dest)
+      continue
+    if member['size'] == 0:
+      open(dest, 'w').close()
+      os.chmod(dest, member['mode'])
+      continue
+    if member_store is not None:
+      stored_member = os.path.join(member_store, member['sha1'])
+      try:
+        link_cached(stored_member, dest)
+        os.utime(stored_member, None)
+        continue
+      except (OSError, IOError):
+        pass
+    missing.append(member)
+  transferred = index['bytes']
+  served_by = set([mirror])
+  if missing != []:
+    (member_bytes, member_mirrors) = fetch_bundle_members(mirrors, 
+                                                          index, 
+                                                          missing,
+                                                          path, 
+                                                          member_store)
+    transferred += member_bytes
+    served_by.update(member_mirrors)
+  record_transfer(mirrors[0], sorted(served_by), transferred)
+  if cache_dir is not None:
+    evict_cache(cache_dir, None)
+  return os.path.join(path, index['top'])
+
+def fetch_chunk(mirrors, chunk_id, chunk_store):
+  """
+  Download a chunk into chunk_store from the first mirror that has it,
+  returns a tuple with the bytes transferred and the mirror used
+  """
+  last_error = None
+  for attempt in range(DOWNLOAD_RETRIES):
+    for mirror in mirrors:
+      try:
+        handle = urllib2.urlopen("%s/chunks/%s" % (mirror, chunk_id),
+                                 timeout=DOWNLOAD_TIMEOUT)
+        compressed = handle.read()
+        handle.close()
+        data = zlib.decompress(compressed)
+      except (IOError, socket.error, httplib.HTTPException, zlib.error), ex:
+        last_error = ex
+        continue
+      if hashlib.sha1(data).hexdigest() != chunk_id:
+        last_error = IOError("Checksum mismatch for chunk %s from %s" % 
+                             (chunk_id, mirror))
+        continue
+      (fhandle, temp_file) = tempfile.mkstemp(dir=chunk_store)
+      os.write(fhandle, data)
+      os.close(fhandle)
+      os.rename(temp_file, os.path.join(chunk_store, chunk_id))
+      return (len(compressed), mirror)
+    time.sleep(2 ** attempt)
+  raise last_error
+
+def read_chunk(mirrors, chunk_id, chunk_store):
+  """
+  Read a chunk from chunk_store, fetching it again if it was evicted 
+  after staging started
+  """
+  chunk_file = os.path.join(chunk_store, chunk_id)
+  try:
+    data = open(chunk_file, 'rb').read()
+  except IOError:
+    fetch_chunk(mirrors, chunk_id, chunk_store)
+    data = open(chunk_file, 'rb').read()
+  return data
+
+def stage_chunked(urls, path, cache_dir=None):
+  """
+  Rebuild an application from a chunk manifest in path, only chunks 
+  that aren't in the node's chunk store are downloaded so a new version
+  of an application costs about as much as the files that changed
+  """
+  mirrors = get_mirrors(urls)
+  url_handle = MirrorReader(mirrors)
+  manifest_data = ''
+  data = url_handle.read()
+  while data:
+    manifest_data += data
+    data = url_handle.read()
+  url_handle.close()
+  try:
+    manifest = json.loads(manifest_data)
+  except ValueError:
+    raise IOError("%s isn't a chunk manifest" % mirrors[0])
+  # chunks are stored next to the manifest
+  chunk_mirrors = [mirror.rsplit('/', 1)[0] for mirror in mirrors]
+  if cache_dir is not None:
+    chunk_store = os.path.join(cache_dir, 'chunks')
+  else:
+    chunk_store = tempfile.mkdtemp(dir=path)
+
+  missing = []
+  for member in manifest['members']:
+    if member['type'] != 'file':
+      continue
+    for (chunk_id, size) in member['chunks']:
+      if chunk_id in missing:
+        continue
+      chunk_file = os.path.join(chunk_store, chunk_id)
+      if os.path.isfile(chunk_file):
+        os.utime(chunk_file, None)
+      else:
+        missing.append(chunk_id)
+  tasks = [(chunk_id, fetch_chunk, (chunk_mirrors, chunk_id, chunk_store))
+           for chunk_id in missing]
+  (results, errors) = run_parallel(tasks)
+  if errors != {}:
+    raise errors.values()[0]
+  transferred = 0
+  served_by = set()
+  for (chunk_bytes, mirror) in results.values():
+    transferred += chunk_bytes
+    served_by.add(mirror)
+  if missing == []:
+    served_by.add('cache')
+  record_transfer(chunk_mirrors[0] + '/chunks', sorted(served_by), transferred)
+
+  for member in manifest['members']:
+    dest = member_path(path, member)
+    if member['type'] == 'dir':
+      if not os.path.isdir(dest):
+        os.makedirs(dest)
+      os.chmod(dest, member['mode'])
+      continue
+    if not os.path.isdir(os.path.dirname(dest)):
+      os.makedirs(os.path.dirname(dest))
+    if member['type'] == 'link':
+      os.symlink(member['target'], dest)
+      continue
+    (fhandle, temp_file) = tempfile.mkstemp(dir=os.path.dirname(dest))
+    for (chunk_id, size) in member['chunks']:
+      os.write(fhandle, read_chunk(chunk_mirrors, chunk_id, chunk_store))
+    os.close(fhandle)
+    os.chmod(temp_file, member['mode'])
+    os.rename(temp_file, dest)
+  if cache_dir is None:
+    shutil.rmtree(chunk_store)
+  else:
+    evict_cache(cache_dir, None)
+  return os.path.join(path, manifest['top'])
+
+def setup_application(directory, cache_dir=None):
   """
   Download application binaries and setup in temp directory
   """
-  app_path = download_tarball(APP_URL, directory)
+  if get_mirrors(APP_URL)[0].endswith(BUNDLE_SUFFIX):
+    return stage_bundle(APP_URL, directory, cache_dir)
+  if get_mirrors(APP_URL)[0].endswith(MANIFEST_SUFFIX):
+    return stage_chunked(APP_URL, directory, cache_dir)
+  app_path = stage_tarball(APP_URL, directory, cache_dir)
   return app_path
 
-def setup_parrot(directory):
+def setup_parrot(directory, cache_dir=None):
   """
   Download correct parrot binaries and setup in temp directory
   """
   sys_ver = platform.dist()[1][0]
-  parrot_url = PARROT_URL + "/parrot-sl%s.tar.gz" % sys_ver
-  parrot_path = download_tarball(parrot_url, directory)
+  parrot_urls = [mirror + "/parrot-sl%s.tar.gz" % sys_ver 
+                 for mirror in get_mirrors(PARROT_URL)]
+  parrot_path = stage_tarball(parrot_urls, directory, cache_dir)
   return parrot_path
 
-def generate_env(parrot_path):
+def parrot_needed():
+  """
+  Check whether the job needs to run under parrot, parrot is only needed
+  if a chirp ticket is used or a cvmfs repository isn't mounted on the
+  node
+  """
+  if TICKET_CONTENTS.strip() != "":
+    return True
+  return get_parrot_repos() != []
+
+def get_parrot_repos():
+  """
+  Get the cvmfs repositories that aren't mounted on the node and have to
+  be accessed through parrot
+  """
+  return [k for k in CVMFS_INFO 
+          if not os.path.isdir(os.path.join('/', 'cvmfs', k))]
+
+def generate_env(parrot_path, native=False):
   """
-  Create a dict with the environment variables for binary + parrot
+  Create a dict with the environment variables for binary + parrot, 
+  parrot specific variables are left out if the binary runs natively
   """
   job_env = os.environ.copy()
     
-  if WEB_PROXY != "":
-    job_env['http_proxy'] = WEB_PROXY
-    job_env['HTTP_PROXY'] = WEB_PROXY
-  if job_env.has_key('OSG_SQUID_LOCATION') and job_env['OSG_SQUID_LOCATION'] != 'UNAVAILABLE':
-    job_env['http_proxy'] = job_env['OSG_SQUID_LOCATION']
-    job_env['HTTP_PROXY'] = job_env['OSG_SQUID_LOCATION']
-  job_env['PARROT_ALLOW_SWITCHING_CVMFS_REPOSITORIES'] = '1'
-  job_env['PARROT_HELPER'] = os.path.join(parrot_path,
-                                          'parrot',
-                                          'lib',
-                                          'libparrot_helper.so')
+  # proxies are only probed if parrot will use them to reach cvmfs, 
+  # otherwise the site squid takes precedence over the configured proxy
+  if not native and get_parrot_repos() != []:
+    proxies = get_ranked_proxies()
+  else:
+    proxies = get_proxy_candidates()[-1:]
+  if proxies != []:
+    job_env['http_proxy'] = proxies[0]
+    job_env['HTTP_PROXY'] = proxies[0]
+  if not native:
+    job_env['PARROT_ALLOW_SWITCHING_CVMFS_REPOSITORIES'] = '1'
+    job_env['PARROT_HELPER'] = os.path.join(parrot_path,
+                                            'parrot',
+                                            'lib',
+                                            'libparrot_helper.so')
   job_env['CHIRP_MOUNT'] = CHIRP_MOUNT
   return job_env 
 
+def get_proxy_candidates():
+  """
+  Get the web proxies configured for the job and the site
+  """
+  candidates = []
+  if WEB_PROXY != "":
+    candidates.append(WEB_PROXY)
+  if os.environ.has_key('OSG_SQUID_LOCATION') and os.environ['OSG_SQUID_LOCATION'] != 'UNAVAILABLE':
+    if os.environ['OSG_SQUID_LOCATION'] not in candidates:
+      candidates.append(os.environ['OSG_SQUID_LOCATION'])
+  return candidates
+
+def get_probe_url():
+  """
+  Get a small file to request through the proxies, the published 
+  manifest of the first cvmfs repository or None if there isn't one
+  """
+  for repo in sorted(CVMFS_INFO):
+    match = re.search(r'url=([^,;]+)', CVMFS_INFO[repo]['options'])
+    if match is not None:
+      return match.group(1).rstrip('/') + '/.cvmfspublished'
+  return None
+
+def probe_proxy(proxy, probe_url):
+  """
+  Measure the time taken to get a response through a proxy, or to 
+  connect to it if there's no url to request, raises an exception if 
+  the proxy doesn't work
+  """
+  if '://' not in proxy:
+    proxy_url = 'http://' + proxy
+  else:
+    proxy_url = proxy
+  start = time.time()
+  if probe_url is None:
+    location = urlparse.urlparse(proxy_url)
+    connection = socket.create_connection((location.hostname, 
+                                           location.port or 80), 
+                                          PROXY_PROBE_TIMEOUT)
+    connection.close()
+    return time.time() - start
+  opener = urllib2.build_opener(urllib2.ProxyHandler({'http': proxy_url}))
+  try:
+    opener.open(probe_url, timeout=PROXY_PROBE_TIMEOUT).read(1)
+  except urllib2.HTTPError, ex:
+    # any answer from the upstream server means the proxy works
+    if ex.code in (502, 503, 504):
+      raise
+  return time.time() - start
+
+def rank_proxies(candidates):
+  """
+  Probe the proxies at the same time and return the ones that work, 
+  fastest first
+  """
+  probe_url = get_probe_url()
+  tasks = []
+  for proxy in candidates:
+    tasks.append((proxy, probe_proxy, (proxy, probe_url)))
+  (latencies, errors) = run_parallel(tasks, len(tasks))
+  for proxy in errors:
+    sys.stderr.write("Not using proxy %s: %s\n" % (proxy, errors[proxy]))
+  return sorted(latencies, key=lambda proxy: latencies[proxy])
+
+def get_ranked_proxies():
+  """
+  Get the working web proxies ordered by latency, the ranking is 
+  stored in the node directory so that jobs starting at the same time 
+  only probe the proxies once
+  """
+  PROXY_LOCK.acquire()
+  try:
+    if 'proxies' in JOB_INFO:
+      return JOB_INFO['proxies']
+    candidates = get_proxy_candidates()
+    if candidates == []:
+      JOB_INFO['proxies'] = candidates
+      return candidates
+    record_path = os.path.join(get_node_dir(), PROXY_RECORD)
+    lock_fd = None
+    try:
+      if not os.path.isdir(get_node_dir()):
+        os.makedirs(get_node_dir(), 0700)
+      lock_fd = lock_file(record_path + '.lock')
+    except OSError:
+      pass
+    try:
+      record = read_record(record_path)
+      if (record is not None and 
+          record.get('candidates') == candidates and
+          time.time() - record.get('time', 0) < PROXY_CACHE_TIME):
+        JOB_INFO['proxies'] = [str(proxy) for proxy in record['ranked']]
+        return JOB_INFO['proxies']
+      ranked = rank_proxies(candidates)
+      if lock_fd is not None:
+        write_record(record_path, {'candidates': candidates,
+                                   'ranked': ranked,
+                                   'time': time.time()})
+    finally:
+      if lock_fd is not None:
+        unlock_file(lock_fd)
+    JOB_INFO['proxies'] = ranked
+    return ranked
+  finally:
+    PROXY_LOCK.release()
+
 def update_proxy(cvmfs_options):
   """
-  Update cvmfs options to use local proxy if available
+  Update cvmfs options to use the working local proxies, fastest first
   """
   new_proxies = ""
-  if WEB_PROXY != "":   
-    new_proxies = WEB_PROXY + ";"
-  if os.environ.has_key('OSG_SQUID_LOCATION') and os.environ['OSG_SQUID_LOCATION'] != 'UNAVAILABLE':
-    new_proxies += "%s;" % os.environ['OSG_SQUID_LOCATION']
+  for proxy in get_ranked_proxies():
+    new_proxies += "%s;" % proxy
   proxy_re = re.compile(r'proxies=(.*?)(,|$)')
   return proxy_re.sub(r'proxies=' + new_proxies + r'\1\2', cvmfs_options)
 
-def create_cvmfs_options():
+def create_cvmfs_options(shared_cache=False):
   """
-  Create  CVMFS options for parrot
+  Create  CVMFS options for parrot, repositories without a quota_limit 
+  get PARROT_CACHE_QUOTA if the parrot cache is shared between jobs
   """
   if len(CVMFS_INFO) == 0:
     return ' '
   cvmfs_opts = ''
-  for k in CVMFS_INFO:
-    if os.path.isdir(os.path.join('/', 'cvmfs', k)):
-      continue
+  for k in get_parrot_repos():
     cvmfs_options = update_proxy(CVMFS_INFO[k]['options'])
+    if shared_cache and 'quota_limit=' not in cvmfs_options:
+      cvmfs_options += ",quota_limit=%d,quota_threshold=%d" % \
+                       (PARROT_CACHE_QUOTA, PARROT_CACHE_QUOTA / 2)
     cvmfs_opts += "%s:%s " % (k, cvmfs_options)
   return cvmfs_opts[:-1]
 
-def get_cvmfs_keys(temp_dir):
+def get_key_store():
   """
-  Download cvmfs keys for repositories that have been defined
+  Get the directory on the node used to keep cvmfs keys between jobs,
+  returns None if it can't be created
   """
+  key_store = os.path.join(get_node_dir(), 'keys')
+  try:
+    if not os.path.isdir(key_store):
+      os.makedirs(key_store, 0700)
+  except OSError:
+    return None
+  return key_store
+
+def get_cvmfs_key_urls():
+  """
+  Get the urls for the keys of the cvmfs repositories that will be
+  configured, repositories sharing a key only get one entry and 
+  repositories mounted on the node are skipped
+  """
+  key_urls = []
   for k in CVMFS_INFO:
-    key_url = CVMFS_INFO[k]['key']
-    url_handle = urllib2.urlopen(key_url)
-    key_name = urlparse.urlparse(key_url)[2].split('/')[-1]
-    key_file = open(os.path.join(temp_dir, key_name), 'w')
+    if os.path.isdir(os.path.join('/', 'cvmfs', k)):
+      continue
+    if CVMFS_INFO[k]['key'] not in key_urls:
+      key_urls.append(CVMFS_INFO[k]['key'])
+  return key_urls
+
+def fetch_cvmfs_key(key_url, key_store):
+  """
+  Make sure the key store has a current copy of the key at key_url,
+  revalidating stored keys with the server, and return its location
+  """
+  stored_key = os.path.join(key_store, hashlib.sha1(key_url).hexdigest())
+  try:
+    key_info = json.loads(open(stored_key + '.info').read())
+  except (IOError, ValueError):
+    key_info = None
+  if key_info is not None and not os.path.isfile(stored_key):
+    key_info = None
+  if (key_info is not None and 
+      key_info.get('checked', 0) > time.time() - KEY_FRESHNESS):
+    return stored_key
+
+  request = urllib2.Request(key_url)
+  if key_info is not None:
+    if key_info.get('etag'):
+      request.add_header('If-None-Match', key_info['etag'])
+    if key_info.get('last_modified'):
+      request.add_header('If-Modified-Since', key_info['last_modified'])
+  try:
+    url_handle = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    key_data = url_handle.read()
+    key_info = {'etag': url_handle.info().getheader('ETag'),
+                'last_modified': url_handle.info().getheader('Last-Modified')}
+  except urllib2.HTTPError, ex:
+    if key_info is None or ex.code != 304:
+      raise
+    key_data = None
+  except urllib2.URLError:
+    # keep using the stored key if the server can't be reached
+    if key_info is None:
+      raise
+    return stored_key
+
+  key_info['checked'] = time.time()
+  if key_data is not None:
+    (fhandle, temp_file) = tempfile.mkstemp(dir=key_store)
+    os.write(fhandle, key_data)
+    os.close(fhandle)
+    os.rename(temp_file, stored_key)
+  (fhandle, temp_file) = tempfile.mkstemp(dir=key_store)
+  os.write(fhandle, json.dumps(key_info))
+  os.close(fhandle)
+  os.rename(temp_file, stored_key + '.info')
+  return stored_key
+
+def get_cvmfs_key(key_url, temp_dir):
+  """
+  Get a cvmfs key, going through the node key store if possible, and 
+  save it in temp_dir
+  """
+  key_name = urlparse.urlparse(key_url)[2].split('/')[-1]
+  key_store = get_key_store()
+  if key_store is not None:
+    try:
+      shutil.copyfile(fetch_cvmfs_key(key_url, key_store),
+                      os.path.join(temp_dir, key_name))
+      return True
+    except urllib2.URLError:
+      raise
+    except (OSError, IOError):
+      # fall back to downloading the key if the key store isn't usable
+      pass
+  url_handle = urllib2.urlopen(key_url, timeout=DOWNLOAD_TIMEOUT)
+  key_file = open(os.path.join(temp_dir, key_name), 'w')
+  url_data = url_handle.read(2048)
+  while url_data:
+    key_file.write(url_data)
     url_data = url_handle.read(2048)
-    while url_data:
-      key_file.write(url_data)
-      url_data = url_handle.read(2048)
-    key_file.close()
-
-def run_application(temp_dir):
-  """
-  Run specified user application in a parrot environment
-  """
-  job_env = generate_env(temp_dir)
-  get_cvmfs_keys(temp_dir)
-  job_args = ['./parrot/bin/parrot_run', 
-              '-t',
-              os.path.join(temp_dir, 'parrot_cache'),
-              '-r',
-              create_cvmfs_options()]
-  if TICKET_CONTENTS != "":
-    job_args.extend(['-i', 'chirp.ticket'])
+  key_file.close()
+  return True
+
+def run_parallel(tasks, max_threads=STAGE_THREADS):
+  """
+  Run a list of (name, function, args) tasks using at most max_threads
+  threads, returns a tuple with a dict of results and a dict with
+  the exceptions raised by failed tasks, both indexed by task name
+  """
+  task_queue = Queue.Queue()
+  for task in tasks:
+    task_queue.put(task)
+  results = {}
+  errors = {}
+
+  def worker():
+    while True:
+      try:
+        (name, function, args) = task_queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[name] = function(*args)
+      except Exception, ex:
+        errors[name] = ex
+
+  threads = []
+  for i in range(min(max_threads, len(tasks))):
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    thread.join()
+  return (results, errors)
+
+def wait_cvmfs_warm(process, start):
+  """
+  Wait for the process warming the parrot cache, stopping it if it's 
+  still running when the application finishes
+  """
+  while process.poll() is None and not BACKGROUND_STOP.isSet():
+    BACKGROUND_STOP.wait(0.2)
+  finished = process.poll() is not None
+  if not finished:
+    try:
+      os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+      pass
+    process.wait()
+  JOB_INFO['cvmfs_warm'] = {'seconds': time.time() - start,
+                            'finished': finished,
+                            'exit_code': process.returncode}
+
+def start_cvmfs_warm(temp_dir, parrot_cache, shared_cache=False):
+  """
+  Start a parrot process reading the CVMFS_WARM paths into parrot_cache
+  """
+  command = ['./parrot/bin/parrot_run', 
+             '-t',
+             parrot_cache,
+             '-r',
+             create_cvmfs_options(shared_cache),
+             '/bin/sh',
+             '-c',
+             CVMFS_WARM_SCRIPT,
+             'sh'] + CVMFS_WARM
+  null_file = open(os.devnull, 'w')
+  try:
+    process = subprocess.Popen(command, 
+                               cwd=temp_dir, 
+                               env=generate_env(temp_dir),
+                               stdout=null_file, 
+                               stderr=null_file,
+                               preexec_fn=os.setsid)
+  except OSError, ex:
+    sys.stderr.write("Can't start warming the parrot cache: %s\n" % ex)
+    return
+  finally:
+    null_file.close()
+  sys.stderr.write("Warming the parrot cache with %d cvmfs paths\n" % 
+                   len(CVMFS_WARM))
+  thread = threading.Thread(target=wait_cvmfs_warm, 
+                            args=(process, time.time()))
+  thread.setDaemon(True)
+  thread.start()
+  BACKGROUND_THREADS.append(thread)
+
+def warm_after(warm_state, function, *args):
+  """
+  Run a staging task that parrot needs before it can read from cvmfs, 
+  the cache is warmed once the last of these tasks succeeds
+  """
+  result = function(*args)
+  warm_state['lock'].acquire()
+  try:
+    warm_state['pending'] -= 1
+    if not result:
+      warm_state['failed'] = True
+    ready = warm_state['pending'] == 0 and not warm_state['failed']
+  finally:
+    warm_state['lock'].release()
+  if ready:
+    start_cvmfs_warm(warm_state['temp_dir'], warm_state['parrot_cache'],
+                     warm_state['shared_cache'])
+  return result
+
+def stage_in(temp_dir, cache_dir, debug=False, native=False, 
+             parrot_cache=None):
+  """
+  Download parrot, the application and cvmfs keys in parallel, returns
+  True if everything was staged.  Parrot isn't downloaded for jobs
+  running natively.  If there are CVMFS_WARM paths they're read into 
+  parrot_cache as soon as parrot and the keys are ready, while the 
+  application is still downloading.
+  """
+  stage_tasks = []
+  if not native:
+    stage_tasks.append(('parrot', timed, 
+                        ('parrot', setup_parrot, temp_dir, cache_dir)))
+  if APP_URL != '':
+    stage_tasks.append(('application', timed, 
+                        ('application', setup_application, 
+                         temp_dir, cache_dir)))
+  for key_url in get_cvmfs_key_urls():
+    stage_tasks.append((key_url, timed, 
+                        ('cvmfs_keys', get_cvmfs_key, key_url, temp_dir)))
+  if CVMFS_WARM != [] and not native:
+    shared_cache = parrot_cache is not None
+    if parrot_cache is None:
+      parrot_cache = os.path.join(temp_dir, 'parrot_cache')
+    warm_state = {'pending': len(stage_tasks), 
+                  'failed': False,
+                  'lock': threading.Lock(),
+                  'temp_dir': temp_dir,
+                  'parrot_cache': parrot_cache,
+                  'shared_cache': shared_cache}
+    for i in range(len(stage_tasks)):
+      (name, function, args) = stage_tasks[i]
+      if name == 'application':
+        warm_state['pending'] -= 1
+      else:
+        stage_tasks[i] = (name, warm_after, (warm_state, function) + args)
+  (results, errors) = run_parallel(stage_tasks)
+
+  staged = True
+  if not native and not results.get('parrot'):
+    sys.stderr.write("Can't download parrot binaries, exiting...\n")
+    staged = False
+  if APP_URL != '' and not results.get('application'):
+    sys.stderr.write("Can't download application binaries, exiting...\n")
+    staged = False
+  for key_url in get_cvmfs_key_urls():
+    if not results.get(key_url):
+      sys.stderr.write("Can't download CVMFS key from %s, " \
+                       "exiting...\n" % key_url)
+      staged = False
+  if debug:
+    for name in errors:
+      sys.stderr.write("Error while staging %s: %s\n" % (name, errors[name]))
+  for transfer in TRANSFERS:
+    sys.stderr.write("Staged %s from %s\n" % (transfer['url'],
+                                             ", ".join(transfer['served_by'])))
+  return staged
+
+def get_shared_parrot_cache():
+  """
+  Get the parrot cache directory shared by jobs on this node, returns None
+  if it can't be created
+  """
+  parrot_cache = os.path.join(get_node_dir(), 'parrot_cache')
+  try:
+    if not os.path.isdir(parrot_cache):
+      os.makedirs(parrot_cache, 0700)
+  except OSError:
+    return None
+  return parrot_cache
+
+def clean_parrot_cache(parrot_cache):
+  """
+  Remove files outside of the cvmfs cache that haven't been used 
+  recently from the shared parrot cache, then remove the least recently 
+  used ones until they're within PARROT_FILES_LIMIT.  The cvmfs cache is 
+  left to cvmfs, which keeps it within quota_limit.  Nothing is done if 
+  the cache was cleaned recently or other jobs are using it.
+  """
+  stamp_file = parrot_cache + '.cleaned'
+  try:
+    last_cleaned = os.path.getmtime(stamp_file)
+    if last_cleaned > time.time() - PARROT_CACHE_CLEAN_INTERVAL:
+      return
+  except OSError:
+    pass
+  cache_lock = lock_file(parrot_cache + '.lock', blocking=False)
+  if cache_lock is None:
+    return
+  try:
+    open(stamp_file, 'w').close()
+    cached_files = []
+    total_size = 0
+    for root, dirs, files in os.walk(parrot_cache):
+      if root == parrot_cache and 'cvmfs' in dirs:
+        dirs.remove('cvmfs')
+      for file_name in files:
+        file_path = os.path.join(root, file_name)
+        try:
+          file_info = os.lstat(file_path)
+        except OSError:
+          continue
+        last_used = max(file_info.st_atime, file_info.st_mtime)
+        cached_files.append((last_used, file_path, file_info.st_size))
+        total_size += file_info.st_size
+    cached_files.sort()
+    for last_used, file_path, size in cached_files:
+      if (last_used > time.time() - PARROT_CACHE_MAX_AGE and 
+          total_size <= PARROT_FILES_LIMIT * 1024 * 1024):
+        break
+      try:
+        os.unlink(file_path)
+      except OSError:
+        continue
+      total_size -= size
+  finally:
+    unlock_file(cache_lock)
+
+def run_application(temp_dir, parrot_cache=None, native=False, 
+                    task_args=None, task_env=None):
+  """
+  Run specified user application in a parrot environment or directly
+  if it runs natively, task_args and task_env replace the wrapper's 
+  arguments and add to the environment when running a task in pilot mode
+  """
+  job_env = generate_env(temp_dir, native)
+  if task_env is not None:
+    job_env.update(task_env)
+  shared_cache = parrot_cache is not None
+  if parrot_cache is None:
+    parrot_cache = os.path.join(temp_dir, 'parrot_cache')
+  if native:
+    job_args = []
+  else:
+    job_args = ['./parrot/bin/parrot_run', 
+                '-t',
+                parrot_cache,
+                '-r',
+                create_cvmfs_options(shared_cache)]
+    if TICKET_CONTENTS != "":
+      job_args.extend(['-i', 'chirp.ticket'])
+    if os.path.isfile(os.path.join(temp_dir, PREFETCH_MOUNTS)):
+      job_args.extend(['-m', os.path.join(temp_dir, PREFETCH_MOUNTS)])
   job_args.append(JOB_SCRIPT)
   if JOB_ARGS != "":
     job_args.extend(JOB_ARGS.split(' '))
   os.chdir(temp_dir)
-  if len(sys.argv) > 1:
+  if task_args is not None:
+    job_args.extend(task_args)
+  elif len(sys.argv) > 1:
     job_args.extend(sys.argv[1:])
 
-  return subprocess.call(job_args, env=job_env)
+  process = subprocess.Popen(job_args, env=job_env)
+  APP_PIDS.append(process.pid)
+  exit_code = process.wait()
+  APP_PIDS.remove(process.pid)
+  return exit_code
+
+def read_tasks(task_file):
+  """
+  Read the argument sets for pilot mode, one task per line with blank
+  lines and lines starting with # skipped, returns a list of argument 
+  lists or None if the file can't be read
+  """
+  tasks = []
+  try:
+    for line in open(task_file):
+      line = line.strip()
+      if line == '' or line.startswith('#'):
+        continue
+      tasks.append(shlex.split(line))
+  except (IOError, ValueError), ex:
+    sys.stderr.write("Can't read task file %s: %s\n" % (task_file, ex))
+    return None
+  return tasks
+
+def get_cgroup_cpus():
+  """
+  Get the number of cpus allowed by the cgroup cpu quota, returns None 
+  if there's no quota
+  """
+  try:
+    # cgroup v2
+    (quota, period) = open('/sys/fs/cgroup/cpu.max').read().split()
+    if quota == 'max':
+      return None
+    return int(math.ceil(float(quota) / float(period)))
+  except (IOError, ValueError):
+    pass
+  for cpu_dir in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+    try:
+      quota = int(open(os.path.join(cpu_dir, 'cpu.cfs_quota_us')).read())
+      period = int(open(os.path.join(cpu_dir, 'cpu.cfs_period_us')).read())
+    except (IOError, ValueError):
+      continue
+    if quota <= 0:
+      return None
+    return int(math.ceil(float(quota) / period))
+  return None
+
+def get_condor_cpus():
+  """
+  Get the number of cpus given to the job's slot from the HTCondor 
+  machine ad, returns None if it's not available
+  """
+  if '_CONDOR_MACHINE_AD' not in os.environ:
+    return None
+  try:
+    for line in open(os.environ['_CONDOR_MACHINE_AD']):
+      match = re.match(r'Cpus\s*=\s*(\d+)\s*$', line)
+      if match is not None:
+        return int(match.group(1))
+  except IOError:
+    pass
+  return None
+
+def get_core_count():
+  """
+  Get the number of cores allotted to the job by the batch system, 
+  using the smallest of the HTCondor slot size, the cgroup cpu quota and
+  the number of cpus on the node
+  """
+  cores = os.sysconf('SC_NPROCESSORS_ONLN')
+  for limit in [get_condor_cpus(), get_cgroup_cpus()]:
+    if limit is not None and limit > 0:
+      cores = min(cores, limit)
+  return max(cores, 1)
+
+def run_task(temp_dir, parrot_cache, native, task_num, task_args, threads):
+  """
+  Run one task in pilot mode, returns a dict with the task's exit code
+  and timing
+  """
+  task_env = {'SK_TASK_ID': str(task_num)}
+  for variable in THREAD_VARIABLES:
+    task_env[variable] = str(threads)
+  start = time.time()
+  try:
+    exit_code = run_application(temp_dir, parrot_cache, native, 
+                                task_args, task_env)
+  except OSError, ex:
+    sys.stderr.write("Can't start task %d: %s\n" % (task_num, ex))
+    exit_code = 127
+  end = time.time()
+  sys.stderr.write("Task %d exited with %d after %.1fs: %s\n" % 
+                   (task_num, exit_code, end - start, " ".join(task_args)))
+  return {'task': task_num,
+          'args': task_args,
+          'exit_code': exit_code,
+          'start': start,
+          'seconds': end - start}
+
+def run_tasks(temp_dir, parrot_cache, native, tasks, slots, threads):
+  """
+  Run the tasks read from the task file using up to slots processes at 
+  a time, returns the number of tasks that failed
+  """
+  sys.stderr.write("Running %d tasks, %d at a time with %d threads each\n" %
+                   (len(tasks), slots, threads))
+  task_list = []
+  for task_num in range(len(tasks)):
+    task_list.append((task_num, run_task, 
+                      (temp_dir, parrot_cache, native, 
+                       task_num, tasks[task_num], threads)))
+  (results, errors) = run_parallel(task_list, slots)
+  JOB_INFO['tasks'] = [results[task_num] for task_num in sorted(results)]
+  failed = 0
+  for result in JOB_INFO['tasks']:
+    if result['exit_code'] != 0:
+      failed += 1
+  failed += len(errors)
+  for task_num in errors:
+    sys.stderr.write("Task %d failed: %s\n" % (task_num, errors[task_num]))
+  sys.stderr.write("%d of %d tasks succeeded\n" % (len(tasks) - failed, 
+                                                   len(tasks)))
+  return failed
+
+def read_process(pid):
+  """
+  Read the parent, start time, cpu seconds, rss bytes, io bytes and open 
+  files of a process from /proc, returns None if it has exited
+  """
+  try:
+    stat = open("/proc/%s/stat" % pid).read()
+  except IOError:
+    return None
+  # the command name can contain spaces so split after it
+  fields = stat[stat.rindex(')') + 2:].split()
+  info = {'ppid': int(fields[1]),
+          'started': fields[19],
+          'cpu': (int(fields[11]) + int(fields[12])) / 
+                 float(os.sysconf('SC_CLK_TCK')),
+          'rss': int(fields[21]) * os.sysconf('SC_PAGE_SIZE'),
+          'read': 0,
+          'write': 0,
+          'files': 0}
+  try:
+    for line in open("/proc/%s/io" % pid):
+      if line.startswith('read_bytes:'):
+        info['read'] = int(line.split()[1])
+      elif line.startswith('write_bytes:'):
+        info['write'] = int(line.split()[1])
+    info['files'] = len(os.listdir("/proc/%s/fd" % pid))
+  except (IOError, OSError):
+    pass
+  return info
+
+class ResourceSampler(object):
+  """
+  Periodically sample the application's processes from /proc while it
+  runs, helpers like the cvmfs cache warming and stage out aren't counted
+  """
+  def __init__(self, interval):
+    self.interval = interval
+    self.samples = collections.deque(maxlen=SAMPLE_BUFFER)
+    # last counters seen for each process so totals include processes
+    # that have exited
+    self.counters = {}
+    self.peaks = {'rss': 0, 'files': 0, 'processes': 0}
+    self.count = 0
+    self.start_time = None
+    self.stop_event = threading.Event()
+    self.thread = threading.Thread(target=self.run)
+    self.thread.setDaemon(True)
+
+  def start(self):
+    self.start_time = time.time()
+    self.thread.start()
+
+  def stop(self):
+    self.stop_event.set()
+    self.thread.join()
+    self.sample()
+
+  def run(self):
+    while not self.stop_event.isSet():
+      self.sample()
+      self.stop_event.wait(self.interval)
+
+  def sample(self):
+    """
+    Add a sample of the application processes and their descendants
+    """
+    processes = {}
+    for pid in os.listdir('/proc'):
+      if pid.isdigit():
+        info = read_process(pid)
+        if info is not None:
+          processes[int(pid)] = info
+    children = {}
+    for pid in processes:
+      children.setdefault(processes[pid]['ppid'], []).append(pid)
+    pending = [pid for pid in list(APP_PIDS) if pid in processes]
+    rss = 0
+    files = 0
+    count = 0
+    while pending:
+      pid = pending.pop()
+      info = processes[pid]
+      self.counters[(pid, info['started'])] = (info['cpu'], 
+                                               info['read'], 
+                                               info['write'])
+      rss += info['rss']
+      files += info['files']
+      count += 1
+      pending.extend(children.get(pid, []))
+    totals = [sum(values) for values in zip(*self.counters.values())]
+    if totals == []:
+      totals = [0, 0, 0]
+    self.samples.append((round(time.time() - self.start_time, 1), 
+                         round(totals[0], 2), rss, totals[1], totals[2], 
+                         files, count))
+    self.peaks['rss'] = max(self.peaks['rss'], rss)
+    self.peaks['files'] = max(self.peaks['files'], files)
+    self.peaks['processes'] = max(self.peaks['processes'], count)
+    self.count += 1
+
+  def summary(self):
+    """
+    Get a dict with totals and peaks for the application and a timeline
+    of at most SAMPLE_TIMELINE points, each point has the peak rss, open
+    files and processes and the totals at the end of its samples
+    """
+    samples = list(self.samples)
+    if samples == []:
+      return {}
+    seconds = samples[-1][0]
+    timeline = []
+    step = int(math.ceil(len(samples) / float(SAMPLE_TIMELINE)))
+    for start in range(0, len(samples), step):
+      group = samples[start:start + step]
+      timeline.append([group[-1][0], group[-1][1], 
+                       max([sample[2] for sample in group]),
+                       group[-1][3], group[-1][4], 
+                       max([sample[5] for sample in group]),
+                       max([sample[6] for sample in group])])
+    return {'interval': self.interval,
+            'samples': self.count,
+            'seconds': seconds,
+            'cpu_seconds': samples[-1][1],
+            'cpu_efficiency': round(samples[-1][1] / max(seconds, 0.1), 2),
+            'peak_rss': self.peaks['rss'],
+            'mean_rss': sum([sample[2] for sample in samples]) / len(samples),
+            'read_bytes': samples[-1][3],
+            'write_bytes': samples[-1][4],
+            'peak_files': self.peaks['files'],
+            'peak_processes': self.peaks['processes'],
+            'timeline_fields': ['seconds', 'cpu_seconds', 'rss', 
+                                'read_bytes', 'write_bytes', 'files', 
+                                'processes'],
+            'timeline': timeline}
+
+def stop_background():
+  """
+  Stop the threads and processes fetching data while the application 
+  runs and wait for them to finish
+  """
+  BACKGROUND_STOP.set()
+  for thread in BACKGROUND_THREADS:
+    thread.join()
+
+def get_output_files(temp_dir):
+  """
+  Get the files in temp_dir matching the output patterns, directories
+  that match include everything in them, returns a sorted list of paths
+  relative to temp_dir
+  """
+  outputs = set()
+  for pattern in STAGE_OUT:
+    for path in glob.glob(os.path.join(temp_dir, pattern)):
+      if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+          for file_name in files:
+            outputs.add(os.path.relpath(os.path.join(root, file_name),
+                                        temp_dir))
+      elif os.path.isfile(path):
+        outputs.add(os.path.relpath(path, temp_dir))
+  return sorted(outputs)
+
+def run_chirp(temp_dir, chirp_args):
+  """
+  Run a chirp client command against the job's chirp server, returns a 
+  tuple with the exit code and output of the command
+  """
+  command = [os.path.join(temp_dir, 'parrot', 'bin', 'chirp'),
+             '-a',
+             'ticket',
+             '-i',
+             os.path.join(temp_dir, 'chirp.ticket'),
+             CHIRP_MOUNT.split('/')[2]]
+  try:
+    chirp = subprocess.Popen(command + chirp_args,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+    output = chirp.communicate()[0]
+  except OSError, ex:
+    return (-1, str(ex))
+  return (chirp.returncode, output)
+
+def file_md5(path):
+  """
+  Get the md5 checksum of a file
+  """
+  checksum = hashlib.md5()
+  source = open(path, 'rb')
+  data = source.read(DOWNLOAD_BUFSIZE)
+  while data:
+    checksum.update(data)
+    data = source.read(DOWNLOAD_BUFSIZE)
+  source.close()
+  return checksum.hexdigest()
+
+def prepare_outputs(temp_dir, outputs, staging_dir, compress, bundle):
+  """
+  Bundle small output files into tarballs if bundle is set and compress
+  the rest if requested, returns a list of (local file, remote file) 
+  tuples to upload
+  """
+  uploads = []
+  bundles = []
+  bundle_size = 0
+  job_name = re.sub(r'[^\w.-]', '_', get_job_id())
+  for output in outputs:
+    local_file = os.path.join(temp_dir, output)
+    size = os.path.getsize(local_file)
+    if bundle and size < STAGE_OUT_SMALL:
+      if bundles == [] or bundle_size + size > STAGE_OUT_BUNDLE_SIZE:
+        bundles.append([])
+        bundle_size = 0
+      bundles[-1].append(output)
+      bundle_size += size
+    elif compress:
+      compressed_file = os.path.join(staging_dir, 
+                                     "%d.gz" % len(uploads))
+      source = open(local_file, 'rb')
+      dest = gzip.open(compressed_file, 'wb')
+      shutil.copyfileobj(source, dest, DOWNLOAD_BUFSIZE)
+      dest.close()
+      source.close()
+      uploads.append((compressed_file, output + '.gz'))
+    else:
+      uploads.append((local_file, output))
+  for bundle_num in range(len(bundles)):
+    if compress:
+      (suffix, mode) = ('.tar.gz', 'w:gz')
+    else:
+      (suffix, mode) = ('.tar', 'w')
+    bundle_file = os.path.join(staging_dir, "bundle-%d%s" % (bundle_num,
+                                                            suffix))
+    tar_file = tarfile.open(bundle_file, mode)
+    for output in bundles[bundle_num]:
+      tar_file.add(os.path.join(temp_dir, output), arcname=output)
+    tar_file.close()
+    uploads.append((bundle_file, 
+                    "outputs-%s-%d%s" % (job_name, bundle_num, suffix)))
+  return uploads
+
+def upload_output(temp_dir, local_file, remote_file):
+  """
+  Copy a file to the chirp server and check that the copy matches,
+  the file is written under a temporary name and renamed once it's 
+  verified, returns the number of bytes copied
+  """
+  checksum = file_md5(local_file)
+  partial_file = remote_file + '.partial'
+  last_error = None
+  for attempt in range(STAGE_OUT_RETRIES):
+    if attempt > 0:
+      time.sleep(2 ** attempt)
+    (retcode, output) = run_chirp(temp_dir, ['put', local_file, partial_file])
+    if retcode != 0:
+      last_error = "put failed: %s" % output.strip()
+      continue
+    (retcode, output) = run_chirp(temp_dir, ['md5', partial_file])
+    if retcode != 0 or output.split() == [] or output.split()[0] != checksum:
+      last_error = "checksum mismatch: %s" % output.strip()
+      continue
+    (retcode, output) = run_chirp(temp_dir, ['mv', partial_file, remote_file])
+    if retcode != 0:
+      last_error = "rename failed: %s" % output.strip()
+      continue
+    return os.path.getsize(local_file)
+  raise IOError("Can't copy %s to %s, %s" % (local_file, remote_file, 
+                                              last_error))
+
+def prefetch_file(temp_dir, remote_file, local_file):
+  """
+  Copy a file from the chirp server to local scratch, returns the number
+  of bytes copied
+  """
+  if not os.path.isdir(os.path.dirname(local_file)):
+    try:
+      os.makedirs(os.path.dirname(local_file))
+    except OSError:
+      # another thread may have created it
+      if not os.path.isdir(os.path.dirname(local_file)):
+        raise
+  (retcode, output) = run_chirp(temp_dir, ['get', remote_file, local_file])
+  if retcode != 0:
+    raise IOError("Can't prefetch %s: %s" % (remote_file, output.strip()))
+  return os.path.getsize(local_file)
+
+def prefetch_inputs(temp_dir, streams):
+  """
+  Copy the files in PREFETCH from the chirp server to temp_dir using
+  several streams at once and write a parrot mount list redirecting 
+  reads of them to the local copies, files that can't be copied are 
+  still read through chirp
+  """
+  if CHIRP_MOUNT == '' or TICKET_CONTENTS.strip() == '':
+    return False
+  prefetch_dir = os.path.join(temp_dir, 'prefetch')
+  tasks = []
+  for path in PREFETCH:
+    remote_file = '/' + path.lstrip('/')
+    tasks.append((remote_file, prefetch_file, 
+                  (temp_dir, remote_file, prefetch_dir + remote_file)))
+  (results, errors) = run_parallel(tasks, streams)
+  mount_list = open(os.path.join(temp_dir, PREFETCH_MOUNTS), 'w')
+  transferred = 0
+  for remote_file in sorted(results):
+    mount_list.write("%s%s %s%s\n" % (CHIRP_MOUNT, remote_file,
+                                      prefetch_dir, remote_file))
+    transferred += results[remote_file]
+  mount_list.close()
+  record_transfer(CHIRP_MOUNT, [CHIRP_MOUNT.split('/')[2]], transferred)
+  for remote_file in errors:
+    sys.stderr.write("%s\n" % errors[remote_file])
+  sys.stderr.write("Prefetched %d of %d inputs (%d bytes)\n" % 
+                   (len(results), len(PREFETCH), transferred))
+  return True
+
+def stage_out(temp_dir, streams, compress, bundle):
+  """
+  Copy the job's outputs to the chirp server using several streams at
+  once, returns True if every output was copied and verified
+  """
+  if CHIRP_MOUNT == '' or TICKET_CONTENTS.strip() == '':
+    sys.stderr.write("Can't stage out outputs without a chirp ticket\n")
+    return False
+  outputs = get_output_files(temp_dir)
+  if outputs == []:
+    sys.stderr.write("No outputs to stage out\n")
+    return True
+  remote_base = '/' + STAGE_OUT_DIR.strip('/')
+  staging_dir = tempfile.mkdtemp(dir=temp_dir)
+  try:
+    try:
+      uploads = prepare_outputs(temp_dir, outputs, staging_dir, compress,
+                                bundle)
+    except (OSError, IOError), ex:
+      sys.stderr.write("Can't prepare outputs for stage out: %s\n" % ex)
+      return False
+    remote_dirs = set()
+    for (local_file, remote_file) in uploads:
+      remote_dirs.add(os.path.dirname(os.path.join(remote_base, remote_file)))
+    for remote_dir in sorted(remote_dirs):
+      run_chirp(temp_dir, ['mkdir', '-p', remote_dir])
+    tasks = []
+    for (local_file, remote_file) in uploads:
+      tasks.append((remote_file, upload_output, 
+                    (temp_dir, local_file, 
+                     os.path.join(remote_base, remote_file))))
+    (results, errors) = run_parallel(tasks, streams)
+  finally:
+    shutil.rmtree(staging_dir, ignore_errors=True)
+  transferred = 0
+  for remote_file in results:
+    transferred += results[remote_file]
+  record_transfer(CHIRP_MOUNT + remote_base, 
+                  [CHIRP_MOUNT.split('/')[2]], 
+                  transferred)
+  for remote_file in errors:
+    sys.stderr.write("%s\n" % errors[remote_file])
+  sys.stderr.write("Staged out %d outputs in %d transfers (%d bytes)\n" % 
+                   (len(outputs), len(results), transferred))
+  return errors == {}
+
+def get_site_name():
+  """
+  Get the name of the site the job is running at
+  """
+  for var in ['OSG_SITE_NAME', 'GLIDEIN_Site', 'GLIDEIN_RESOURCE_NAME']:
+    if os.environ.get(var):
+      return os.environ[var]
+  return 'unknown'
+
+def get_job_id():
+  """
+  Get an id for the job, using the condor job ad if it's available
+  """
+  if '_CONDOR_JOB_AD' in os.environ:
+    try:
+      for line in open(os.environ['_CONDOR_JOB_AD']):
+        match = re.match(r'GlobalJobId\s*=\s*"(.*)"', line)
+        if match is not None:
+          return match.group(1)
+    except IOError:
+      pass
+  return "%s#%d#%d" % (socket.gethostname(), os.getpid(), int(JOB_START))
+
+def select_chirp_server():
+  """
+  Pick the chirp server for this job, servers are ordered by a hash of 
+  the job id and server so jobs spread evenly over the servers and the 
+  jobs of an unreachable server spread evenly over the rest
+  """
+  job_id = get_job_id()
+  servers = sorted(CHIRP_SERVERS, 
+                   key=lambda server: hashlib.md5(job_id + server).digest(),
+                   reverse=True)
+  for server in servers:
+    (host, port) = server.rsplit(':', 1)
+    try:
+      connection = socket.create_connection((host, int(port)), 
+                                            CHIRP_PROBE_TIMEOUT)
+      connection.close()
+      return server
+    except (socket.error, ValueError):
+      sys.stderr.write("Can't connect to chirp server %s\n" % server)
+  return servers[0]
+
+def get_timing_record(exit_code):
+  """
+  Get a dict with the time taken and bytes downloaded in each phase of
+  the job
+  """
+  record = {'version': VERSION,
+            'host': socket.gethostname(),
+            'site': get_site_name(),
+            'job_id': get_job_id(),
+            'start': JOB_START,
+            'seconds': time.time() - JOB_START,
+            'exit_code': exit_code,
+            'bytes': 0,
+            'phases': {},
+            'transfers': TRANSFERS}
+  record.update(JOB_INFO)
+  for phase in PHASES:
+    record['phases'][phase] = {'seconds': PHASES[phase][1] - PHASES[phase][0],
+                               'bytes': 0}
+  for transfer in TRANSFERS:
+    record['bytes'] += transfer['bytes']
+    if transfer['phase'] in record['phases']:
+      record['phases'][transfer['phase']]['bytes'] += transfer['bytes']
+  return record
+
+def save_chirp_client(temp_dir):
+  """
+  Copy the chirp client and ticket out of temp_dir so that the timing
+  record can be written after temp_dir is removed, returns the 
+  directory they were copied to
+  """
+  client_dir = tempfile.mkdtemp()
+  try:
+    shutil.copy2(os.path.join(temp_dir, 'parrot', 'bin', 'chirp'),
+                 os.path.join(client_dir, 'chirp'))
+    shutil.copy2(os.path.join(temp_dir, 'chirp.ticket'),
+                 os.path.join(client_dir, 'chirp.ticket'))
+  except (OSError, IOError):
+    pass
+  return client_dir
+
+def write_timing_record(destination, exit_code, client_dir):
+  """
+  Write the timing record for the job as a line of JSON to destination,
+  client_dir has the chirp client and ticket used for chirp destinations
+  """
+  if destination == '':
+    return True
+  record = json.dumps(get_timing_record(exit_code)) + "\n"
+  if destination == '-':
+    sys.stderr.write(record)
+    return True
+  if destination.startswith('chirp:'):
+    if CHIRP_MOUNT == '' or TICKET_CONTENTS.strip() == '':
+      sys.stderr.write("Can't write timing record to chirp without a " \
+                       "ticket\n")
+      return False
+    (fhandle, record_file) = tempfile.mkstemp(dir=client_dir)
+    os.write(fhandle, record)
+    os.close(fhandle)
+    remote_file = "%s/%s.json" % (destination[6:].rstrip('/'),
+                                  re.sub(r'[^\w.-]', '_', get_job_id()))
+    chirp_args = [os.path.join(client_dir, 'chirp'),
+                  '-a',
+                  'ticket',
+                  '-i',
+                  os.path.join(client_dir, 'chirp.ticket'),
+                  CHIRP_MOUNT.split('/')[2],
+                  'put',
+                  record_file,
+                  remote_file]
+    try:
+      null_file = open(os.devnull, 'w')
+      retcode = subprocess.call(chirp_args, stdout=null_file, stderr=null_file)
+    except OSError:
+      retcode = -1
+    os.unlink(record_file)
+    if retcode != 0:
+      sys.stderr.write("Can't write timing record to %s\n" % remote_file)
+      return False
+    return True
+  try:
+    # a single write to a file opened for appending keeps lines from 
+    # concurrent jobs intact
+    fhandle = os.open(destination, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    os.write(fhandle, record)
+    os.close(fhandle)
+  except OSError, ex:
+    sys.stderr.write("Can't write timing record to %s: %s\n" % 
+                     (destination, ex))
+    return False
+  return True
+
+def finish_job(destination, exit_code, temp_dir, remove_dir):
+  """
+  Remove temp_dir if requested and write out the timing record for 
+  the job
+  """
+  client_dir = None
+  if destination.startswith('chirp:'):
+    client_dir = save_chirp_client(temp_dir)
+  if remove_dir:
+    timed('cleanup', shutil.rmtree, temp_dir)
+  write_timing_record(destination, exit_code, client_dir)
+  if client_dir is not None:
+    shutil.rmtree(client_dir)
 
 def main():
   """Setup and run application"""
+  global CHIRP_MOUNT
   parser = optparse.OptionParser(version="%prog " + VERSION)
   parser.add_option("-d", "--debug", 
                     dest="debug",
@@ -212,6 +2370,71 @@ def main():
                     help="Preserver working directory for debugging",
                     action="store_true", 
                     default=False)
+  parser.add_option("--no-cache", 
+                    dest="no_cache",
+                    help="Don't use the node cache for parrot and " \
+                         "application tarballs",
+                    action="store_true", 
+                    default=False)
+  parser.add_option("--shared-parrot-cache", 
+                    dest="shared_parrot_cache",
+                    help="Keep the parrot cache on the node and share it " \
+                         "with other jobs",
+                    action="store_true", 
+                    default=SHARED_PARROT_CACHE)
+  parser.add_option("--timing-log", 
+                    dest="timing_log",
+                    help="Write a JSON record of the time taken by each " \
+                         "phase of the job to a file, - for stderr or " \
+                         "chirp:<directory>",
+                    default=TIMING_LOG)
+  parser.add_option("--force-parrot", 
+                    dest="force_parrot",
+                    help="Run the application under parrot even if " \
+                         "it could run natively",
+                    action="store_true", 
+                    default=False)
+  parser.add_option("--task-file", 
+                    dest="task_file",
+                    help="Stage once and run a task for each line of " \
+                         "arguments in this file",
+                    default=TASK_FILE)
+  parser.add_option("--task-slots", 
+                    dest="task_slots",
+                    help="Number of tasks to run at the same time, " \
+                         "defaults to the cores allotted to the job " \
+                         "divided by --task-threads",
+                    type="int",
+                    default=0)
+  parser.add_option("--task-threads", 
+                    dest="task_threads",
+                    help="Number of threads each task may use",
+                    type="int",
+                    default=TASK_THREADS)
+  parser.add_option("--stage-out-streams", 
+                    dest="stage_out_streams",
+                    help="Number of outputs to copy to the chirp server " \
+                         "at the same time",
+                    type="int",
+                    default=STAGE_OUT_STREAMS)
+  parser.add_option("--compress-outputs", 
+                    dest="compress_outputs",
+                    help="Compress outputs before copying them to the " \
+                         "chirp server",
+                    action="store_true", 
+                    default=STAGE_OUT_COMPRESS)
+  parser.add_option("--bundle-outputs", 
+                    dest="bundle_outputs",
+                    help="Copy small outputs to the chirp server in " \
+                         "tarballs",
+                    action="store_true", 
+                    default=STAGE_OUT_BUNDLE)
+  parser.add_option("--sample-interval", 
+                    dest="sample_interval",
+                    help="Seconds between samples of the resources used " \
+                         "by the application, 0 to turn sampling off",
+                    type="float",
+                    default=SAMPLE_INTERVAL)
   (options, args) = parser.parse_args()  
   try:
     temp_dir = tempfile.mkdtemp()
@@ -219,6 +2442,10 @@ def main():
     sys.stderr.write("Can't create temporary directory, exiting...\n")
     sys.exit(1)
 
+  if options.no_cache:
+    cache_dir = None
+  else:
+    cache_dir = get_cache_dir()
 
   if TICKET_CONTENTS != "":
     if not ticket_valid():
@@ -228,29 +2455,89 @@ def main():
       sys.stderr.write("Can't create ticket, exiting...\n")
       sys.exit(1)
    
+  if CHIRP_SERVERS != [] and TICKET_CONTENTS.strip() != '':
+    CHIRP_MOUNT = "/chirp/%s" % select_chirp_server()
+    JOB_INFO['chirp_server'] = CHIRP_MOUNT.split('/')[2]
+
   if USER_PROXY != "":
     if not write_proxy(temp_dir):
       sys.stderr.write("Can't create user proxy, exiting...\n")
       sys.exit(1)
    
-  if not setup_parrot(temp_dir):
-    sys.stderr.write("Can't download parrot binaries, exiting...\n")
-    sys.exit(1)
-  if APP_URL != '':
-    if not setup_application(temp_dir):       
-      sys.stderr.write("Can't download application binaries, exiting...\n")
+  tasks = None
+  if options.task_file != '':
+    tasks = read_tasks(options.task_file)
+    if tasks is None:
       sys.exit(1)
-  exit_code = run_application(temp_dir)
+    options.task_threads = max(options.task_threads, 1)
+    if options.task_slots <= 0:
+      options.task_slots = max(get_core_count() / options.task_threads, 1)
+
+  native = not options.force_parrot and not parrot_needed()
+  if native:
+    JOB_INFO['mode'] = 'native'
+    sys.stderr.write("CVMFS repositories are mounted on the node and " \
+                     "chirp isn't used, running application natively\n")
+  else:
+    JOB_INFO['mode'] = 'parrot'
+    sys.stderr.write("Running application under parrot\n")
+  parrot_cache = None
+  cache_lock = None
+  if options.shared_parrot_cache and not native:
+    parrot_cache = get_shared_parrot_cache()
+    if parrot_cache is not None:
+      # hold a shared lock so the cache isn't cleaned while parrot uses it
+      cache_lock = lock_file(parrot_cache + '.lock', exclusive=False)
+  if not timed('stage_in', stage_in, temp_dir, cache_dir, options.debug, 
+               native, parrot_cache):
+    stop_background()
+    finish_job(options.timing_log, 1, temp_dir, False)
+    sys.exit(1)
+  if PREFETCH != [] and not native:
+    timed('prefetch', prefetch_inputs, temp_dir, PREFETCH_STREAMS)
+  sampler = None
+  if options.sample_interval > 0:
+    sampler = ResourceSampler(options.sample_interval)
+    sampler.start()
+  if tasks is None:
+    exit_code = timed('payload', run_application, temp_dir, parrot_cache, 
+                      native)
+  elif timed('payload', run_tasks, temp_dir, parrot_cache, native, tasks, 
+             options.task_slots, options.task_threads) == 0:
+    exit_code = 0
+  else:
+    exit_code = 1
+  if sampler is not None:
+    sampler.stop()
+    JOB_INFO['resources'] = sampler.summary()
+    if JOB_INFO['resources'] != {}:
+      sys.stderr.write("Application used %(cpu_seconds).1f cpu seconds, " \
+                       "peak rss %(peak_rss)d bytes, read %(read_bytes)d " \
+                       "bytes, wrote %(write_bytes)d bytes, peak open " \
+                       "files %(peak_files)d\n" % JOB_INFO['resources'])
+  stop_background()
+  if cache_lock is not None:
+    unlock_file(cache_lock)
+    clean_parrot_cache(parrot_cache)
+  if STAGE_OUT != []:
+    # copy outputs even if the application failed to help with debugging
+    if (not timed('stage_out', stage_out, temp_dir, 
+                  max(options.stage_out_streams, 1), 
+                  options.compress_outputs, options.bundle_outputs) and
+        exit_code == 0):
+      sys.stderr.write("Can't stage out outputs\n")
+      exit_code = 1
   if exit_code != 0:
     sys.stderr.write("Application exited with error\n")
     if options.debug:
       sys.stderr.write("Exit code: %d\n" % exit_code)
+    finish_job(options.timing_log, exit_code, temp_dir, False)
     sys.exit(exit_code)
     
   if options.preserve_dir:
     sys.stdout.write("Temp directory at %s\n" % temp_dir)
-  else:
-    shutil.rmtree(temp_dir)
+  finish_job(options.timing_log, exit_code, temp_dir, 
+             not options.preserve_dir)
   sys.exit(exit_code)
 
 if __name__ == '__main__':